@@ -0,0 +1,134 @@
+# Persistent on-disk cache of UCA verification results, so that
+# re-running the tool on an unchanged system and set of UCAs doesn't
+# have to invoke the solver again.
+
+from control import Action, BinaryExpr, Expr, FloatLiteral, Ident, IntLiteral, \
+    NAryExpr, System, UCA, UnaryExpr
+import dbm
+from hashlib import blake2b
+import os
+import pickle
+import shelve
+from typing import List, Optional, Sequence, Tuple, TYPE_CHECKING
+if TYPE_CHECKING:
+    # Only for annotations, since solver imports this module.
+    from solver import Scenario
+
+# Bump this whenever the meaning or shape of cached results changes
+# (e.g., the encoding of UCAs in solver.py, or the layout of Scenario)
+# to invalidate old entries.
+CACHE_VERSION = 2
+
+# Whether the cache should be used at all (set STPA_NO_CACHE to a
+# non-empty value to neither read nor write it).
+def cacheEnabled() -> bool:
+    return not os.environ.get('STPA_NO_CACHE')
+
+# Directory containing the cache ($XDG_CACHE_HOME/stpa or ~/.cache/stpa).
+def cacheDir() -> str:
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'stpa')
+
+# Canonical s-expression form of an expression. Chains of AND/OR
+# (binary or n-ary, however they're nested) are flattened into a single
+# n-ary form, and operands of commutative operators are sorted, so that
+# trivially reassociated or reordered expressions get the same cache key.
+def canonicalExpr(e: Expr) -> str:
+    match e:
+        case IntLiteral():
+            return str(e.i)
+        case FloatLiteral():
+            return repr(e.f)
+        case 'true' | 'false':
+            return str(e)
+        case Ident():
+            return str(e)
+        case UnaryExpr():
+            return '(%s %s)' % (e.op, canonicalExpr(e.e))
+        case BinaryExpr() if e.op in ['AND', 'OR']:
+            return __canonicalAndOr(e)
+        case BinaryExpr():
+            args = [canonicalExpr(e.e1), canonicalExpr(e.e2)]
+            if e.op in ['EQ', 'PLUS', 'MULT']:
+                args.sort()
+            return '(%s %s)' % (e.op, ' '.join(args))
+        case NAryExpr():
+            return __canonicalAndOr(e)
+
+# Canonical form of an AND/OR chain: the operands of all the nested
+# AND/ORs of the same kind, sorted.
+def __canonicalAndOr(e: BinaryExpr | NAryExpr) -> str:
+    op = e.op
+    operands: List[str] = []
+    stack: List[Expr] = [e]
+    while stack:
+        x = stack.pop()
+        if isinstance(x, BinaryExpr) and x.op == op:
+            stack.extend((x.e1, x.e2))
+        elif isinstance(x, NAryExpr) and x.op == op:
+            stack.extend(x.es)
+        else:
+            operands.append(canonicalExpr(x))
+    return '(%s %s)' % (op, ' '.join(sorted(operands)))
+
+# Canonical form of a list of expressions that are implicitly
+# conjoined or disjoined (so their order doesn't matter).
+def canonicalExprs(es: Sequence[Expr]) -> str:
+    return '(%s)' % ' '.join(sorted(canonicalExpr(e) for e in es))
+
+def canonicalAction(a: Action) -> str:
+    return '(action %s %s %s)' % (a.name, canonicalExprs(a.allowed), canonicalExprs(a.required))
+
+def canonicalSystem(s: System) -> str:
+    return '(system %s (%s) (%s) %s (%s) (%s))' % \
+        (s.name,
+         ' '.join('(%s %s)' % (t.name, ' '.join(t.elements)) for t in s.types),
+         ' '.join('(%s %s)' % (v.name, v.ty) for v in s.vars),
+         canonicalExprs(s.invariants),
+         ' '.join(canonicalAction(a) for a in s.actions),
+         ' '.join(canonicalSystem(c) for c in s.components))
+
+def canonicalUCA(u: UCA) -> str:
+    return '(uca %s %s %s)' % (u.action, u.type, canonicalExpr(u.context))
+
+# Content digest of a system alone, so that equal systems built
+# separately (e.g., parsed again or unpickled) can share solver state.
+# Cached on the system (which is immutable).
+def systemDigest(sys: System) -> str:
+    digest = sys._digest
+    if digest is None:
+        digest = blake2b(canonicalSystem(sys).encode(), digest_size = 32).hexdigest()
+        object.__setattr__(sys, '_digest', digest)
+    return digest
+
+# Cache key for checking a list of UCAs against a system. The order of
+# the UCAs matters since only the first counterexample is reported.
+def cacheKey(sys: System, ucas: Sequence[UCA]) -> str:
+    h = blake2b(digest_size = 32)
+    h.update(b'%d\n' % CACHE_VERSION)
+    h.update(canonicalSystem(sys).encode())
+    for u in ucas:
+        h.update(b'\n')
+        h.update(canonicalUCA(u).encode())
+    return h.hexdigest()
+
+# Look up the result of checking UCAs. Returns None on a cache miss,
+# or else a singleton tuple containing the cached counterexample (which
+# is itself None if all the UCAs were verified).
+def lookupResult(key: str) -> Optional[Tuple[Optional['Scenario']]]:
+    try:
+        with shelve.open(os.path.join(cacheDir(), 'results'), flag = 'r') as db:
+            result: Optional[Tuple[Optional['Scenario']]] = db.get(key)
+            return result
+    except (OSError, *dbm.error, pickle.UnpicklingError, KeyError):
+        # Missing or unreadable cache is just a miss.
+        return None
+
+# Record the result of checking UCAs.
+def storeResult(key: str, counterexample: Optional['Scenario']) -> None:
+    try:
+        os.makedirs(cacheDir(), exist_ok = True)
+        with shelve.open(os.path.join(cacheDir(), 'results')) as db:
+            db[key] = (counterexample,)
+    except (OSError, *dbm.error):
+        pass # Failing to write the cache shouldn't stop the tool.
@@ -1,9 +1,9 @@
 # Type and expression language abstract syntax, system data structures.
 
 from __future__ import annotations
-from dataclasses import dataclass
-from functools import reduce
-from typing import List, Literal, Optional
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Literal, Mapping, Optional, Sequence, Tuple
+from weakref import WeakValueDictionary
 
 # # Source metadata. NOT USED YET
 # @dataclass
@@ -16,57 +16,111 @@ from typing import List, Literal, Optional
 # def metaPretty(m: Meta) -> str:
 #     return 'line %s, column %s' % (m.start_line, m.start_column)
 
-@dataclass(frozen=True)
+# Needs a weakref slot for the intern table.
+@dataclass(frozen=True, slots=True, weakref_slot=True)
 class Ident:
     qualifier: Optional[Ident]
     name: str
     
-    def __str__(self) -> str:
+    # String representation and list of names, computed once on
+    # construction (the qualifier's are already cached so this is
+    # constant work per Ident rather than a walk of the whole chain).
+    _str:   str             = field(init=False, repr=False, compare=False)
+    _names: Tuple[str, ...] = field(init=False, repr=False, compare=False)
+    
+    def __post_init__(self) -> None:
         if self.qualifier is None:
-            return self.name
+            object.__setattr__(self, '_str', self.name)
+            object.__setattr__(self, '_names', (self.name,))
         else:
-            return str(self.qualifier) + '.' + self.name
+            object.__setattr__(self, '_str', self.qualifier._str + '.' + self.name)
+            object.__setattr__(self, '_names', self.qualifier._names + (self.name,))
+    
+    def __str__(self) -> str:
+        return self._str
+    
+    # Hash the cached string (CPython caches string hashes too) instead
+    # of recursively hashing the qualifier chain.
+    def __hash__(self) -> int:
+        return hash(self._str)
+    
+    # Interned Idents are compared by identity. Otherwise compare the
+    # flat tuples of names rather than recursively comparing qualifiers.
+    def __eq__(self, other: object) -> bool:
+        if self is other:
+            return True
+        if not isinstance(other, Ident):
+            return NotImplemented
+        return self._names == other._names
     
     def toList(self) -> List[str]:
-        if self.qualifier:
-            return self.qualifier.toList() + [self.name]
-        else:
-            return [self.name]
+        return list(self._names)
+    
+    # Unpickle (e.g., from the result cache) through the intern table.
+    def __reduce__(self) -> Tuple[object, Tuple[Optional[Ident], str]]:
+        return (Ident.intern, (self.qualifier, self.name))
+    
+    # Get the interned Ident with the given qualifier and name, so that
+    # equal names built this way share a single object (making dict
+    # lookups keyed on them hit the identity fast path).
+    @staticmethod
+    def intern(qualifier: Optional[Ident], name: str) -> Ident:
+        key = (id(qualifier), name)
+        ident = _interned_idents.get(key)
+        if ident is None:
+            ident = _interned_idents[key] = Ident(qualifier, name)
+        return ident
     
     @staticmethod
     def ofList(l: List[str]) -> Ident:
-        if l:
-            if len(l) == 1:
-                return Ident(None, l[0])
-            else:
-                return Ident(Ident.ofList(l[:-1]), l[-1])
-        else:
+        ident: Optional[Ident] = None
+        for name in l:
+            ident = Ident.intern(ident, name)
+        if ident is None:
             raise Exception('Ident.ofList: empty list')
+        return ident
     
     @staticmethod
     def ofStr(s: str) -> Ident:
         return Ident.ofList(s.split('.'))
 
+# Interned Idents keyed by the id of the qualifier and the name. The
+# qualifier is kept alive by the interned Ident itself, so its id can't
+# be reused while the entry exists.
+_interned_idents: WeakValueDictionary[Tuple[int, str], Ident] = WeakValueDictionary()
+
 Type = Literal['bool', 'int', 'real'] | Ident
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class VarDecl:
     name: str
     ty: Type
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class FinTypeDecl:
     name: str
-    elements: List[str]
+    elements: Sequence[str]
+    
+    def __post_init__(self) -> None:
+        object.__setattr__(self, 'elements', tuple(self.elements))
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class IntLiteral:
     i: int
     
     def __str(self) -> str:
         return str(self.i)
+    
+    # Get an IntLiteral, sharing a single object for small integers.
+    @staticmethod
+    def of(i: int) -> IntLiteral:
+        lit = _small_int_literals.get(i)
+        return IntLiteral(i) if lit is None else lit
+
+# Preallocated literals for small integers (like CPython's small int cache).
+_small_int_literals: Dict[int, IntLiteral] = { i: IntLiteral(i) for i in range(-128, 257) }
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class FloatLiteral:
     f: float
     
@@ -75,18 +129,35 @@ class FloatLiteral:
 
 LiteralExpr = FloatLiteral | IntLiteral | Literal['true', 'false']
 
-@dataclass(frozen=True)
+# Unary and binary expressions built with the helper constructors below
+# are hash-consed: building the same operator applied to the same
+# (identical) operands again returns the existing node. Shared
+# subexpressions are then shared objects, which is what the id-keyed
+# caches of the typechecker, simplifier and compiler key on.
+
+@dataclass(frozen=True, slots=True, weakref_slot=True)
 class UnaryExpr:
     op: Literal['NOT']
     e: Expr
     
     def __str__(self) -> str:
         return '%s %s' % (self.op, self.e)
+    
+    # Get the interned node (as with Ident.intern).
+    @staticmethod
+    def intern(op: Literal['NOT'], e: Expr) -> UnaryExpr:
+        key = (op, id(e))
+        node = _interned_unary.get(key)
+        if node is None:
+            node = _interned_unary[key] = UnaryExpr(op = op, e = e)
+        return node
+
+BinOp = Literal['AND', 'OR', 'LT', 'LE', 'GT', 'GE', 'EQ',
+                'PLUS', 'MINUS', 'MULT', 'DIV', 'WHEN']
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True, weakref_slot=True)
 class BinaryExpr:
-    op: Literal['AND', 'OR', 'LT', 'LE', 'GT', 'GE', 'EQ',
-                'PLUS', 'MINUS', 'MULT', 'DIV', 'WHEN']
+    op: BinOp
     e1: Expr
     e2: Expr
     
@@ -95,97 +166,317 @@ class BinaryExpr:
             return 'WHEN %s, %s' % (self.e1, self.e2)
         else:
             return '%s %s %s' % (self.e1, self.op, self.e2)
-
-Expr = Ident | LiteralExpr | UnaryExpr | BinaryExpr
+    
+    # Get the interned node (as with Ident.intern).
+    @staticmethod
+    def intern(op: BinOp, e1: Expr, e2: Expr) -> BinaryExpr:
+        key = (op, id(e1), id(e2))
+        node = _interned_binary.get(key)
+        if node is None:
+            node = _interned_binary[key] = BinaryExpr(op = op, e1 = e1, e2 = e2)
+        return node
+
+# Interned nodes keyed by operator and the ids of the operands (which
+# the nodes keep alive, so the ids can't be reused while the entries
+# exist).
+_interned_unary: WeakValueDictionary[Tuple[str, int], UnaryExpr] = WeakValueDictionary()
+_interned_binary: WeakValueDictionary[Tuple[str, int, int], BinaryExpr] = WeakValueDictionary()
+
+# Flat n-ary conjunction/disjunction (built by 'conj' and 'disj' so
+# that big conjunctions are a single node rather than a deep tree of
+# BinaryExprs).
+@dataclass(frozen=True, slots=True)
+class NAryExpr:
+    op: Literal['AND', 'OR']
+    es: Tuple[Expr, ...]
+    
+    def __str__(self) -> str:
+        return (' %s ' % self.op).join(str(e) for e in self.es)
+
+Expr = Ident | LiteralExpr | UnaryExpr | BinaryExpr | NAryExpr
+
+# Immediate subexpressions of an expression.
+def subExprs(e: Expr) -> Tuple[Expr, ...]:
+    match e:
+        case UnaryExpr():
+            return (e.e,)
+        case BinaryExpr():
+            return (e.e1, e.e2)
+        case NAryExpr():
+            return e.es
+        case _:
+            return ()
 
 #| Helper constructors for expressions.
 
 # Unary negation.
 def neg(e: Expr) -> Expr:
-    return UnaryExpr(op = 'NOT', e = e)
+    return UnaryExpr.intern('NOT', e)
 
 # Binary conjunction ('and' is a reserved keyword in Python so we use
 # 'land' instead to stand for "logical AND").
 def land(e1: Expr, e2: Expr) -> Expr:
-    return BinaryExpr(op = 'AND', e1 = e1, e2 = e2)
+    return BinaryExpr.intern('AND', e1, e2)
+
+# Flatten operands of an n-ary expression, splicing in the operands
+# of any nested NAryExprs with the same operator and dropping the
+# operator's unit ('true' for AND, 'false' for OR). Returns None if the
+# operator's absorbing element ('false' for AND, 'true' for OR) is one
+# of the operands.
+def flattenNAry(op: Literal['AND', 'OR'], es: List[Expr]) -> Optional[Tuple[Expr, ...]]:
+    unit, absorbing = ('true', 'false') if op == 'AND' else ('false', 'true')
+    flat: List[Expr] = []
+    for e in es:
+        if isinstance(e, NAryExpr) and e.op == op:
+            flat.extend(e.es)
+        elif e == absorbing:
+            return None
+        elif e != unit:
+            flat.append(e)
+    return tuple(flat)
+
+# Whether some operand is the negation of another one (compared by
+# identity, so this is a linear check that catches the common case of
+# an interned Ident appearing both plain and negated).
+def __hasComplement(es: Tuple[Expr, ...]) -> bool:
+    ids = { id(e) for e in es }
+    return any(isinstance(e, UnaryExpr) and id(e.e) in ids for e in es)
+
+# Build an n-ary expression, short-circuiting when possible (including
+# when an operand and its negation both appear).
+def nary(op: Literal['AND', 'OR'], es: List[Expr]) -> Expr:
+    flat = flattenNAry(op, es)
+    if flat is None or __hasComplement(flat):
+        return 'false' if op == 'AND' else 'true'
+    elif not flat:
+        return 'true' if op == 'AND' else 'false'
+    elif len(flat) == 1:
+        return flat[0]
+    else:
+        return NAryExpr(op = op, es = flat)
 
 # Big conjunction of list of expressions.
 def conj(es: List[Expr]) -> Expr:
-    return reduce(land, es, 'true')
+    return nary('AND', es)
 
 # Binary disjunction ('or' is a reserved keyword in Python so we use
 # 'lor' instead to stand for "logical OR").
 def lor(e1: Expr, e2: Expr) -> Expr:
-    return BinaryExpr(op = 'OR', e1 = e1, e2 = e2)
+    return BinaryExpr.intern('OR', e1, e2)
 
 # Big disjunction of list of expressions.
 def disj(es: List[Expr]) -> Expr:
-    return reduce(lor, es, 'false')
+    return nary('OR', es)
 
 # Less-than comparison.
 def lt(e1: Expr, e2: Expr) -> Expr:
-    return BinaryExpr(op = 'LT', e1 = e1, e2 = e2)
+    return BinaryExpr.intern('LT', e1, e2)
 
 # Less-than-or-equal comparison.
 def le(e1: Expr, e2: Expr) -> Expr:
-    return BinaryExpr(op = 'LE', e1 = e1, e2 = e2)
+    return BinaryExpr.intern('LE', e1, e2)
 
 # Greater-than comparison.
 def gt(e1: Expr, e2: Expr) -> Expr:
-    return BinaryExpr(op = 'GT', e1 = e1, e2 = e2)
+    return BinaryExpr.intern('GT', e1, e2)
 
 # Greater-than-or-equal comparison.
 def ge(e1: Expr, e2: Expr) -> Expr:
-    return BinaryExpr(op = 'GE', e1 = e1, e2 = e2)
+    return BinaryExpr.intern('GE', e1, e2)
 
 # Equality comparison.
 def eq(e1: Expr, e2: Expr) -> Expr:
-    return BinaryExpr(op = 'EQ', e1 = e1, e2 = e2)
+    return BinaryExpr.intern('EQ', e1, e2)
 
 # Integer addition.
 def plus(e1: Expr, e2: Expr) -> Expr:
-    return BinaryExpr(op = 'PLUS', e1 = e1, e2 = e2)
+    return BinaryExpr.intern('PLUS', e1, e2)
 
 # Integer subtraction.
 def minus(e1: Expr, e2: Expr) -> Expr:
-    return BinaryExpr(op = 'MINUS', e1 = e1, e2 = e2)
+    return BinaryExpr.intern('MINUS', e1, e2)
 
 # Integer multiplication.
 def mult(e1: Expr, e2: Expr) -> Expr:
-    return BinaryExpr(op = 'MULT', e1 = e1, e2 = e2)
+    return BinaryExpr.intern('MULT', e1, e2)
 
 # Integer division.
 def div(e1: Expr, e2: Expr) -> Expr:
-    return BinaryExpr(op = 'DIV', e1 = e1, e2 = e2)
+    return BinaryExpr.intern('DIV', e1, e2)
 
 # Logical implication.
 def when(e1: Expr, e2: Expr) -> Expr:
-    return BinaryExpr(op = 'WHEN', e1 = e1, e2 = e2)
+    return BinaryExpr.intern('WHEN', e1, e2)
+
+#| Simplification.
+
+# Integer operators that can be folded when both arguments are literals.
+__int_ops: Dict[str, Callable[[int, int], int | bool]] = {
+    'LT':    lambda x, y: x < y,
+    'LE':    lambda x, y: x <= y,
+    'GT':    lambda x, y: x > y,
+    'GE':    lambda x, y: x >= y,
+    'EQ':    lambda x, y: x == y,
+    'PLUS':  lambda x, y: x + y,
+    'MINUS': lambda x, y: x - y,
+    'MULT':  lambda x, y: x * y }
+
+def __boolLit(b: bool) -> Expr:
+    return 'true' if b else 'false'
+
+# Simplify a single node whose children have already been simplified
+# (given in the same order as subExprs).
+def __simplifyNode(e: Expr, cs: List[Expr]) -> Expr:
+    match e:
+        case UnaryExpr():
+            c, = cs
+            if c == 'true' or c == 'false':
+                return __boolLit(c == 'false')
+            elif isinstance(c, UnaryExpr):
+                return c.e # NOT NOT x = x
+            return e if c is e.e else neg(c)
+        case NAryExpr():
+            return nary(e.op, cs)
+        case BinaryExpr():
+            c1, c2 = cs
+            if e.op == 'AND' or e.op == 'OR':
+                return nary(e.op, cs)
+            elif e.op == 'WHEN':
+                if c1 == 'true':
+                    return c2
+                elif c1 == 'false' or c2 == 'true':
+                    return 'true'
+                elif c2 == 'false':
+                    return __simplifyNode(neg(c1), [c1])
+            elif isinstance(c1, IntLiteral) and isinstance(c2, IntLiteral):
+                if e.op in __int_ops:
+                    v = __int_ops[e.op](c1.i, c2.i)
+                    return __boolLit(v) if isinstance(v, bool) else IntLiteral.of(v)
+                elif e.op == 'DIV' and c1.i >= 0 and c2.i > 0:
+                    # Only fold when floor and SMT-LIB division agree.
+                    return IntLiteral.of(c1.i // c2.i)
+            elif e.op == 'EQ' and (c1 is c2 or
+                                   (c1 in ['true', 'false'] and c2 in ['true', 'false'])):
+                return __boolLit(c1 == c2)
+            return e if c1 is e.e1 and c2 is e.e2 else BinaryExpr.intern(e.op, c1, c2)
+        case _:
+            return e
+
+# Constant-fold an expression: drop units of AND/OR and collapse on
+# absorbing elements, eliminate double negation, simplify implications
+# with constant sides, and evaluate operators applied to literals.
+# Unchanged subexpressions are shared with the original. The optional
+# memo table (keyed by id, so it must not outlive the expressions)
+# lets a caller simplify many expressions that share subexpressions.
+def simplify(e: Expr, memo: Optional[Dict[int, Expr]] = None) -> Expr:
+    if memo is None:
+        memo = {}
+    # Explicit post-order traversal (as in tycheckExpr).
+    stack: List[Expr] = [e]
+    while stack:
+        top = stack[-1]
+        if id(top) in memo:
+            stack.pop()
+            continue
+        children = subExprs(top)
+        missing = [c for c in children if id(c) not in memo]
+        if missing:
+            stack.extend(reversed(missing))
+        else:
+            stack.pop()
+            memo[id(top)] = __simplifyNode(top, [memo[id(c)] for c in children])
+    return memo[id(e)]
 
 #| System data structures.
 
-@dataclass(frozen=True)
+# The sequence fields of Action and System (and FinTypeDecl above) are
+# converted to tuples on construction, so that systems really are
+# immutable and hashable (and can safely be used as keys of caches).
+
+@dataclass(frozen=True, slots=True)
 class Action:
-    name:     str        # Name of action (e.g., CA1).
-    allowed:  List[Expr] # Constraints for when action is allowed.
-    required: List[Expr] # Constraints for when action is required.
+    name:     str            # Name of action (e.g., CA1).
+    allowed:  Sequence[Expr] # Constraints for when action is allowed.
+    required: Sequence[Expr] # Constraints for when action is required.
+    
+    def __post_init__(self) -> None:
+        object.__setattr__(self, 'allowed', tuple(self.allowed))
+        object.__setattr__(self, 'required', tuple(self.required))
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class System:
-    name:       str               # Name of system.
-    types:      List[FinTypeDecl] # Type declarations.
-    vars:       List[VarDecl]     # Internal state of system.
-    invariants: List[Expr]        # Invariant properties of internal
-                                  # state and/or components.
-    actions:    List[Action]      # Control actions that can be
-                                  # performed by this system/component.
-    components: List[System]      # Subsystems / components.
+    name:       str                   # Name of system.
+    types:      Sequence[FinTypeDecl] # Type declarations.
+    vars:       Sequence[VarDecl]     # Internal state of system.
+    invariants: Sequence[Expr]        # Invariant properties of internal
+                                      # state and/or components.
+    actions:    Sequence[Action]      # Control actions that can be
+                                      # performed by this system/component.
+    components: Sequence[System]      # Subsystems / components.
+    
+    # Cached result of flattenActions.
+    _flat_actions: Optional[Tuple[Tuple[Ident, Action], ...]] = \
+        field(default=None, init=False, repr=False, compare=False)
+    
+    # Cached typing context (see tycheck.ensureTyped).
+    _typing_ctx: Optional[Dict[Ident, Type]] = \
+        field(default=None, init=False, repr=False, compare=False)
+    
+    # Cached result of actionIndex.
+    _action_index: Optional[Dict[Ident, Action]] = \
+        field(default=None, init=False, repr=False, compare=False)
+    
+    # Cached content digest (see cache.systemDigest).
+    _digest: Optional[str] = \
+        field(default=None, init=False, repr=False, compare=False)
+    
+    def __post_init__(self) -> None:
+        object.__setattr__(self, 'types', tuple(self.types))
+        object.__setattr__(self, 'vars', tuple(self.vars))
+        object.__setattr__(self, 'invariants', tuple(self.invariants))
+        object.__setattr__(self, 'actions', tuple(self.actions))
+        object.__setattr__(self, 'components', tuple(self.components))
+    
+    # Summary representation. The default dataclass repr would build
+    # one giant string dumping every component, action, and constraint.
+    def __repr__(self) -> str:
+        return 'System(name=%r, types=%d, vars=%d, invariants=%d, actions=%d, components=%d)' % \
+            (self.name, len(self.types), len(self.vars), len(self.invariants),
+             len(self.actions), len(self.components))
+
+# All actions of a system and its components (in the same order as a
+# depth-first traversal) paired with their fully qualified names. The
+# result is computed once per system and cached on it.
+def flattenActions(sys: System) -> Tuple[Tuple[Ident, Action], ...]:
+    flat = sys._flat_actions
+    if flat is None:
+        actions: List[Tuple[Ident, Action]] = []
+        # Explicit stack of subsystems and their parents' qualifiers.
+        stack: List[Tuple[System, Optional[Ident]]] = [(sys, None)]
+        while stack:
+            s, parent = stack.pop()
+            qualifier: Ident = Ident.intern(parent, s.name)
+            actions.extend((Ident.intern(qualifier, a.name), a) for a in s.actions)
+            stack.extend((c, qualifier) for c in reversed(s.components))
+        flat = tuple(actions)
+        object.__setattr__(sys, '_flat_actions', flat)
+    return flat
+
+# Dictionary mapping the fully qualified names of all actions in the
+# system to the actions themselves (cached on the system, so don't
+# modify it).
+def actionIndex(sys: System) -> Mapping[Ident, Action]:
+    index = sys._action_index
+    if index is None:
+        index = dict(flattenActions(sys))
+        object.__setattr__(sys, '_action_index', index)
+    return index
 
 # Just the first two types for now (I believe the other two can be
 # simulated via these two anyway).
 UCAType = Literal['issued', 'not issued']
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class UCA:
     action:  Ident   # Name of action.
     type:    UCAType # Type of UCA.
@@ -1,10 +1,11 @@
 # Test tool on example system.
 
+from cache import cacheEnabled, cacheKey, lookupResult, storeResult
 from control import Action, conj, eq, FinTypeDecl, Ident, neg, System, Type, UCA, VarDecl, when
 # from parser import parseBytes
-from solver import assertInvariants, checkConstraints, genAllowedScenarios, \
-    genRequiredScenarios, setupYicesContext
-from tycheck import buildTypingCtx, tycheckSystem, tycheckUCA, TypeError
+from solver import assertInvariantsFlat, checkConstraints, genAllScenarios, \
+    resetSolverCache, setupYicesContext, SolverError
+from tycheck import ensureTyped, tycheckUCA, TyMemo, TypeError
 from typing import Any, Dict, List, Mapping, Optional, Tuple
 from yices import Config, Context, Model, Status, Types, Terms
 
@@ -124,18 +125,34 @@ ucas: List[UCA] = \
 
 # Check that the system is well-formed.
 try:
-    ctx: Mapping[Ident, Type] = buildTypingCtx(sys)
-    tycheckSystem(sys, ctx)
+    ctx: Mapping[Ident, Type] = ensureTyped(sys)
+    memo: TyMemo = {} # Shared by the UCA contexts.
     for u in ucas:
-        tycheckUCA(u, ctx)
+        tycheckUCA(u, ctx, memo)
 except TypeError as err:
     print(err.msg)
     exit(-1)
 
-# Verify UCAs against system specification.
-yices_ctx, env, fintype_els = setupYicesContext(ctx, sys)
-assertInvariants(yices_ctx, env, sys)
-counterexample = checkConstraints(yices_ctx, ctx, env, fintype_els, sys, ucas)
+# Verify UCAs against system specification, unless the result for
+# this exact system and set of UCAs is already cached (in which case the
+# solver isn't set up at all). Set STPA_NO_CACHE to bypass the cache. Unsatisfiable invariants (or ill-formed
+# action constraints) mean there's nothing to check.
+use_cache = cacheEnabled()
+key = cacheKey(sys, ucas)
+cached = lookupResult(key) if use_cache else None
+if cached is None:
+    try:
+        yices_ctx, env, fintype_els = setupYicesContext(ctx, sys)
+        assertInvariantsFlat(yices_ctx, env, sys)
+    except SolverError as err:
+        print(err.msg)
+        exit(-1)
+    counterexample = checkConstraints(yices_ctx, ctx, env, fintype_els, sys, ucas)
+    if use_cache:
+        storeResult(key, counterexample)
+else:
+    print('Using cached UCA verification results.')
+    counterexample, = cached
 if counterexample:
     print('Failed to verify UCA. Counterexample:')
     print(counterexample)
@@ -154,22 +171,17 @@ if counterexample:
 # for everything other than identifiers appearing in constraint
 # expressions...
 def printScenarios(system: System) -> None:
-    def go(s: System, parent: Optional[Ident]) -> None:
-        qualifier = Ident(parent, s.name)
-        for a in s.actions:
-            print("\nScenarios in which action '%s' is ALLOWED:" % Ident(qualifier, a.name))
-            for scen in genAllowedScenarios(yices_ctx, ctx, env, fintype_els, a):
-                print(scen)
-            print("\nScenarios in which action '%s' is REQUIRED:" % Ident(qualifier, a.name))
-            for scen in genRequiredScenarios(yices_ctx, ctx, env, fintype_els, a):
-                print(scen)
-        for c in s.components:
-            go(c, qualifier)
-    go(system, None)
+    for name, (allowed, required) in genAllScenarios(system).items():
+        print("\nScenarios in which action '%s' is ALLOWED:" % name)
+        for scen in allowed:
+            print(scen)
+        print("\nScenarios in which action '%s' is REQUIRED:" % name)
+        for scen in required:
+            print(scen)
 
 printScenarios(sys)
 
-yices_ctx.dispose()
+resetSolverCache()
 
 # # Load source program.
 # src = open("test.stpa", "rb").read()
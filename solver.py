@@ -1,11 +1,21 @@
 # Compiling systems to SMT and invoking the solver (currently yices2).
 
-from control import Action, BinaryExpr, conj, disj, eq, Expr, FloatLiteral, \
-    FinTypeDecl, Ident, IntLiteral, land, lor, neg, System, Type, UCA, UnaryExpr
+from cache import systemDigest
+from control import Action, actionIndex, BinaryExpr, conj, disj, eq, Expr, FloatLiteral, \
+    FinTypeDecl, flattenActions, Ident, IntLiteral, NAryExpr, neg, simplify, \
+    subExprs, System, Type, UCA, UCAType, UnaryExpr
+from collections import Counter
+import ctypes
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
 from dataclasses import dataclass
-from typing import Dict, List, Mapping, Iterator, Optional, Sequence, Tuple
+import io
+import os
+from tycheck import ensureTyped, fvs, fvsInto
+from typing import Any, Callable, Dict, ItemsView, List, Mapping, Iterator, Optional, Sequence, Set, Tuple
 from yices import Config, Context, Model, Status, Types, Terms
 import yices # So we can refer to yices.Type.
+import yices_api # For the garbage collector (not wrapped by yices).
 Term = int # Make typechecker happy.
 
 # TODO: It might be nice to (somewhere, perhaps not in this tool but
@@ -23,66 +33,281 @@ def printEnv(env: Mapping[Ident, Term]) -> None:
     for name, tm in env.items():
         print('%s: %s' % (name, tm))
 
-# Compile expressions to yices expressions.
-def compileExpr(env: Mapping[Ident, Term], e: Expr) -> Term:
-    match e:
-        case IntLiteral():
-            return Terms.integer(e.i)
-        case FloatLiteral():
-            return Terms.parse_float(e.f)
-        case 'true':
-            return Terms.true()
-        case 'false':
-            return Terms.false()
-        case Ident():
-            if e in env:
-                return env[e]
-            else:
-                raise SolverError('compileExpr: %s not found in environment %s' % (e, env))
-        case UnaryExpr():
-            return Terms.ynot(compileExpr(env, e.e))
-        case BinaryExpr():
-            c1, c2 = compileExpr(env, e.e1), compileExpr(env, e.e2)
-            if e.op == 'AND':
-                return Terms.yand([c1, c2])
-            elif e.op == 'OR':
-                return Terms.yor([c1, c2])
-            else:
-                return { 'LT':    Terms.arith_lt_atom,
-                         'LE':    Terms.arith_leq_atom,
-                         'GT':    Terms.arith_gt_atom,
-                         'GE':    Terms.arith_geq_atom,
-                         'EQ':    Terms.eq,
-                         'PLUS':  Terms.add,
-                         'MINUS': Terms.sub,
-                         'MULT':  Terms.mul,
-                         'DIV':   Terms.idiv,
-                         'WHEN':  Terms.implies }[e.op](c1, c2)
+# Cache for compileExpr mapping ids of already-compiled expressions to
+# their terms, so that shared subexpressions are only compiled once.
+# Each expression is stored alongside its term to keep it alive, so its
+# id can't be reused by a different expression while the entry exists.
+TermCache = Dict[int, Tuple[Expr, Term]]
+
+# Compile expressions to yices expressions. The tree is walked in
+# post-order with an explicit stack (as in tycheckExpr), so large
+# expressions don't hit Python's recursion limit. Each node is compiled
+# from the already-cached terms of its operands.
+def compileExpr(env: Mapping[Ident, Term], e: Expr, cache: Optional[TermCache] = None) -> Term:
+    if cache is None:
+        cache = {}
+    stack: List[Expr] = [e]
+    while stack:
+        top = stack[-1]
+        if id(top) in cache:
+            stack.pop()
+            continue
+        operands = __operands(top)
+        missing = [x for x in operands if id(x) not in cache]
+        if missing:
+            # Reversed so that operands are compiled left to right.
+            stack.extend(reversed(missing))
+        else:
+            stack.pop()
+            cache[id(top)] = (top, __compileNode(env, top, [cache[id(x)][1] for x in operands]))
+    return cache[id(e)][1]
+
+# Operands of a node for compilation. Chains of AND (or OR) nodes are
+# compiled to a single n-ary term, so their operands are those of the
+# whole chain.
+def __operands(e: Expr) -> Sequence[Expr]:
+    if isinstance(e, (BinaryExpr, NAryExpr)) and (e.op == 'AND' or e.op == 'OR'):
+        return __andOrOperands(e)
+    return subExprs(e)
+
+# Yices term constructors for binary operators other than AND/OR
+# (which are compiled to n-ary terms).
+__binop_terms: Dict[str, Callable[[Term, Term], Term]] = {
+    'LT':    Terms.arith_lt_atom,
+    'LE':    Terms.arith_leq_atom,
+    'GT':    Terms.arith_gt_atom,
+    'GE':    Terms.arith_geq_atom,
+    'EQ':    Terms.eq,
+    'PLUS':  Terms.add,
+    'MINUS': Terms.sub,
+    'MULT':  Terms.mul,
+    'DIV':   Terms.idiv,
+    'WHEN':  Terms.implies }
+
+# Constant terms, built once.
+__true_term: Term = Terms.true()
+__false_term: Term = Terms.false()
+
+# Terms of the integer literals compiled so far, so each one costs a
+# single call into yices. Only literals appearing in compiled
+# expressions go through this cache (so its size is bounded by the
+# expressions), not values read from models.
+__int_terms: Dict[int, Term] = {}
+
+# Term constructors used for every node, bound once rather than looked
+# up on the Terms class per call.
+__yand: Callable[[List[Term]], Term] = Terms.yand
+__yor: Callable[[List[Term]], Term] = Terms.yor
+__ynot: Callable[[Term], Term] = Terms.ynot
+
+# Compile a single node given the terms of its operands, dispatching on
+# its class with one dictionary lookup (the boolean literals are plain
+# strings, so they're handled first).
+def __compileNode(env: Mapping[Ident, Term], e: Expr, ts: List[Term]) -> Term:
+    if e == 'true':
+        return __true_term
+    elif e == 'false':
+        return __false_term
+    return __node_compilers[type(e)](env, e, ts)
+
+def __compileIntLiteral(env: Mapping[Ident, Term], e: IntLiteral, ts: List[Term]) -> Term:
+    return __intTerm(e.i)
+
+def __intTerm(i: int) -> Term:
+    tm = __int_terms.get(i)
+    if tm is None:
+        tm = __int_terms[i] = Terms.integer(i)
+    return tm
+
+def __compileFloatLiteral(env: Mapping[Ident, Term], e: FloatLiteral, ts: List[Term]) -> Term:
+    return Terms.parse_float(e.f)
+
+def __compileIdent(env: Mapping[Ident, Term], e: Ident, ts: List[Term]) -> Term:
+    # Single probe (env keys are usually the same interned objects as
+    # the names in expressions, so this is an identity hit).
+    tm = env.get(e)
+    if tm is None:
+        raise SolverError('compileExpr: %s not found in environment %s' % (e, env))
+    return tm
+
+def __compileUnaryExpr(env: Mapping[Ident, Term], e: UnaryExpr, ts: List[Term]) -> Term:
+    # e.op == 'NOT'
+    return __ynot(ts[0])
+
+def __compileBinaryExpr(env: Mapping[Ident, Term], e: BinaryExpr, ts: List[Term]) -> Term:
+    if e.op == 'AND':
+        return __yand(ts)
+    elif e.op == 'OR':
+        return __yor(ts)
+    else:
+        return __binop_terms[e.op](ts[0], ts[1])
+
+def __compileNAryExpr(env: Mapping[Ident, Term], e: NAryExpr, ts: List[Term]) -> Term:
+    return __yand(ts) if e.op == 'AND' else __yor(ts)
+
+__node_compilers: Dict[type, Callable[[Mapping[Ident, Term], Any, List[Term]], Term]] = {
+    IntLiteral:   __compileIntLiteral,
+    FloatLiteral: __compileFloatLiteral,
+    Ident:        __compileIdent,
+    UnaryExpr:    __compileUnaryExpr,
+    BinaryExpr:   __compileBinaryExpr,
+    NAryExpr:     __compileNAryExpr }
+
+# Operands of a tree of AND (or OR) nodes, in left-to-right order. E.g.,
+# the operands of '(a AND b) AND (c AND d)' are [a, b, c, d]. Yices
+# 'and'/'or' are n-ary, so the whole tree can be compiled to one term.
+def __andOrOperands(e: BinaryExpr | NAryExpr) -> List[Expr]:
+    operands: List[Expr] = []
+    stack: List[Expr] = [e]
+    while stack:
+        x = stack.pop()
+        if isinstance(x, (BinaryExpr, NAryExpr)) and x.op == e.op:
+            stack.extend(reversed(subExprs(x)))
+        else:
+            operands.append(x)
+    return operands
+
+# Compile the conjunction of a list of expressions directly to a single
+# n-ary yices term (without building the 'conj' expression first).
+def compileConj(env: Mapping[Ident, Term], es: Sequence[Expr],
+                cache: Optional[TermCache] = None) -> Term:
+    if cache is None:
+        cache = {}
+    return Terms.yand([compileExpr(env, e, cache) for e in es])
+
+# Compile the disjunction of a list of expressions directly to a single
+# n-ary yices term (without building the 'disj' expression first).
+def compileDisj(env: Mapping[Ident, Term], es: Sequence[Expr],
+                cache: Optional[TermCache] = None) -> Term:
+    if cache is None:
+        cache = {}
+    return Terms.yor([compileExpr(env, e, cache) for e in es])
+
+# Yices contexts already set up for systems, keyed by the content
+# digests of the systems (see cache.systemDigest), so equal systems
+# built separately share a context. Each entry keeps the system it was
+# set up for alive.
+__contexts: Dict[str, Tuple[System, Context, Dict[Ident, Term], Dict[Ident, List[Ident]]]] = {}
+
+# Term caches of environments, keyed by the ids of the environments
+# (each entry keeps its environment alive). Expressions compiled
+# against a cached context's environment stay compiled until
+# resetSolverCache, so e.g. the contexts of UCAs checked again (or
+# shared between UCAs checked in separate calls) aren't recompiled.
+__term_caches: Dict[int, Tuple[Mapping[Ident, Term], TermCache]] = {}
+
+# The persistent term cache of an environment.
+def __envTermCache(env: Mapping[Ident, Term]) -> TermCache:
+    entry = __term_caches.get(id(env))
+    if entry is None:
+        entry = __term_caches[id(env)] = (env, {})
+    return entry[1]
 
 # Set up the yices context by traversing the system and declaring all
 # types and terms. Returns dictionaries mapping identifiers to their
-# corresponding yices terms.
+# corresponding yices terms. Setting up the same system again (or an
+# equal one) reuses the existing context, so re-verifying an unchanged
+# system doesn't redeclare everything; the typing context argument is
+# then ignored, since it's determined by the system.
+
+# The returned context is shared by every caller setting up an equal
+# system and owned by the cache: it must not be disposed (release it
+# with resetSolverCache instead), and nothing should be asserted into
+# it other than through assertInvariantsFlat.
+
+# The context is created in yices' 'multi-checks' mode, which doesn't
+# support push/pop at all (all queries are made with assumptions
+# instead) but lets yices apply its full non-incremental preprocessing.
+# Since nothing can be popped, anything asserted into a context stays
+# there, including when the context is reused. The only assertions
+# made after setup are the system invariants, which assertInvariantsFlat
+# asserts just once per context.
 def setupYicesContext(ctx: Mapping[Ident, Type], # Typing context.
                       sys: System,               # System.
                       ) -> Tuple[Context,                   # Yices context.
                                  Dict[Ident, Term],         # Yices term environment.
                                  Dict[Ident, List[Ident]]]: # FinType elements.
+    digest = systemDigest(sys)
+    entry = __contexts.get(digest)
+    if entry is not None:
+        owner, yices_ctx, env, fintype_els = entry
+        if owner is not sys:
+            __aliasSystem(owner, sys)
+    else:
+        yices_ctx, env, fintype_els = __newYicesContext(ctx, sys)
+        __contexts[digest] = (sys, yices_ctx, env, fintype_els)
+    return yices_ctx, env, fintype_els
+
+# Make the per-object compiled state of a system (its compiled actions
+# and invariants, keyed by object ids) available for an equal system
+# sharing its context.
+def __aliasSystem(owner: System, sys: System) -> None:
+    for (_, a), (_, b) in zip(flattenActions(owner), flattenActions(sys)):
+        entry = __compiled_actions.get(id(a))
+        if entry is not None and id(b) not in __compiled_actions:
+            _, env, allowed, required = entry
+            __compiled_actions[id(b)] = (b, env, allowed, required)
+    invariants = __compiled_invariants.get(id(owner))
+    if invariants is not None and id(sys) not in __compiled_invariants:
+        _, env, terms, yices_ctx, error = invariants
+        __compiled_invariants[id(sys)] = (sys, env, terms, yices_ctx, error)
+
+# Dispose of all the cached yices contexts (and forget everything
+# compiled against them).
+def resetSolverCache() -> None:
+    for _, yices_ctx, _, _ in __contexts.values():
+        yices_ctx.dispose()
+    __contexts.clear()
+    __compiled_invariants.clear()
+    __compiled_actions.clear()
+    __term_caches.clear()
+    __all_scenario_vars.clear()
+
+# Run the yices garbage collector, keeping every term cached by this
+# module (the declared variables, FinTypes and action terms are named,
+# so they're kept anyway). Terms built and held by callers (e.g., in
+# their own TermCaches) may be collected, so this is only called in
+# worker processes, between self-contained pieces of work.
+def __collectGarbage() -> None:
+    keep: List[Term] = [__true_term, __false_term, *__int_terms.values()]
+    for _, cache in __term_caches.values():
+        keep.extend(tm for _, tm in cache.values())
+    for _, _, terms, _, _ in __compiled_invariants.values():
+        keep.extend(terms)
+    for _, _, (allowed, _), (required, _) in __compiled_actions.values():
+        keep.extend([allowed, required])
+    yices_api.yices_garbage_collect((ctypes.c_int32 * len(keep))(*keep), len(keep), None, 0, 1)
+
+def __newYicesContext(ctx: Mapping[Ident, Type], # Typing context.
+                      sys: System,               # System.
+                      ) -> Tuple[Context,                   # Yices context.
+                                 Dict[Ident, Term],         # Yices term environment.
+                                 Dict[Ident, List[Ident]]]: # FinType elements.
     bool_t: yices.Type = Types.bool_type()     # Shorthand for yices bool type.
     int_t: yices.Type = Types.int_type()       # Shorthand for yices int type.
     
-    yices_ctx: Context = Context(Config())     # Yices context.
+    config: Config = Config()                  # Yices configuration.
+    config.set_config('mode', 'multi-checks')
+    yices_ctx: Context = Context(config)       # Yices context.
     env: Dict[Ident, Term] = {}                # Yices term environment.
     types: Dict[Ident, yices.Type] = {}        # Yices type environment.
     fintype_els: Dict[Ident, List[Ident]] = {} # FinType elements.
+    cache: TermCache = {}                      # Compiled constraints.
+    
+    # Compiled actions, published to the module's caches (along with
+    # the term cache) only once the context is known to be well-formed,
+    # so nothing compiled against an abandoned environment is left
+    # behind in them.
+    compiled: Dict[int, Tuple[Action, Tuple[Term, Set[Ident]], Tuple[Term, Set[Ident]]]] = {}
 
     def go(s: System, parent: Optional[Ident]) -> None:
         # Qualifier for current system.
-        qualifier: Ident = Ident(parent, s.name)
+        qualifier: Ident = Ident.intern(parent, s.name)
         
         # Declare enum types.
         for tydecl in s.types:
-            name: Ident = Ident(qualifier, tydecl.name)
-            elements: List[Ident] = [Ident(qualifier, el) for el in tydecl.elements]
+            name: Ident = Ident.intern(qualifier, tydecl.name)
+            elements: List[Ident] = [Ident.intern(qualifier, el) for el in tydecl.elements]
             ty, terms = Types.declare_enum(str(name), [str(el) for el in elements])
             types[name] = ty
             fintype_els[name] = elements
@@ -91,7 +316,7 @@ def setupYicesContext(ctx: Mapping[Ident, Type], # Typing context.
 
         # Declare state variables.
         for vardecl in s.vars:
-            name = Ident(qualifier, vardecl.name)
+            name = Ident.intern(qualifier, vardecl.name)
             match vardecl.ty:
                 case 'bool':
                     env[name] = Terms.new_uninterpreted_term(bool_t, str(name))
@@ -102,99 +327,210 @@ def setupYicesContext(ctx: Mapping[Ident, Type], # Typing context.
 
         # Actions.
         for a in s.actions:
-            action_name = Ident(qualifier, a.name)
-            allowed_name = Ident(action_name, 'allowed')
-            required_name = Ident(action_name, 'required')
+            action_name = Ident.intern(qualifier, a.name)
+            allowed_name = Ident.intern(action_name, 'allowed')
+            required_name = Ident.intern(action_name, 'required')
             env[allowed_name] = Terms.new_uninterpreted_term(bool_t, str(allowed_name))
             env[required_name] = Terms.new_uninterpreted_term(bool_t, str(required_name))
 
-            # a.allowed ⇔ ⋀a.allowed.
-            yices_ctx.assert_formula(Terms.iff(env[allowed_name],
-                                               compileExpr(env, conj(a.allowed))))
-            if yices_ctx.check_context() == Status.UNSAT:
-                raise SolverError("Action '%s' 'allowed' assumptions are ill-formed" %
-                                  action_name)
-            
-            # a.required ⇔ ⋁a.required.
-            yices_ctx.assert_formula(Terms.iff(env[required_name],
-                                               compileExpr(env, disj(a.required))))
-            if yices_ctx.check_context() == Status.UNSAT:
-                raise SolverError("Action '%s' 'required' assumptions are ill-formed" %
-                                  action_name)
+            # Compile the constraints once, keeping them around for
+            # the scenario generators.
+            allowed = __compileConstraints(env, a.allowed, compileConj, cache)
+            required = __compileConstraints(env, a.required, compileDisj, cache)
+            compiled[id(a)] = (a, allowed, required)
+
+            # a.allowed ⇔ ⋀a.allowed and a.required ⇔ ⋁a.required.
+            # The definitions are over fresh variables, so they can
+            # only be unsatisfiable if something is badly wrong; that's
+            # checked once for all actions after the traversal.
+            yices_ctx.assert_formulas([Terms.iff(env[allowed_name], allowed[0]),
+                                       Terms.iff(env[required_name], required[0])])
             
             # Check that allowed and required constraints are
             # consistent. I.e., that required implies allowed, or
             # equivalently, that not allowed implies not required.
+            # (If the context were unsatisfiable this would pass, but
+            # then the check below fails.)
             # TODO: this should probably be done later, after
             # asserting system invariants.
-            yices_ctx.push()
-            yices_ctx.assert_formula(Terms.yand([env[required_name],
-                                                 Terms.ynot(env[allowed_name])]))
-            if yices_ctx.check_context() == Status.SAT:
+            if yices_ctx.check_context_with_assumptions(
+                    None, [env[required_name], Terms.ynot(env[allowed_name])]) == Status.SAT:
                 model = Model.from_context(yices_ctx, 1)
-                yices_ctx.pop()
+                scenario = scenarioFromModel(yices_ctx, ctx, env, fintype_els, model)
                 raise SolverError("Action '%s' required but not allowed in scenario %s" %
-                                  (action_name,
-                                   scenarioFromModel(yices_ctx, ctx, env, fintype_els, model)))
-            yices_ctx.pop()
+                                  (action_name, scenario))
             
         # Recurse on subsystems.
         for c in s.components:
             go(c, qualifier)
 
-    go(sys, None)
+    try:
+        go(sys, None)
+        if yices_ctx.check_context() == Status.UNSAT:
+            raise SolverError("System '%s' action constraints are ill-formed" % sys.name)
+    except BaseException:
+        # Don't keep the abandoned context, or the scenario variables of
+        # its environment (classified when reporting a scenario), around.
+        __all_scenario_vars.pop(id(env), None)
+        yices_ctx.dispose()
+        raise
+    __term_caches[id(env)] = (env, cache)
+
+    # The scenarios of an action are projected onto the cone of
+    # influence of its own variables and constraints: the variables that
+    # the invariants (or other actions' definitions) tie to them aren't
+    # don't-cares, so they're reported too.
+    links = __influenceLinks(sys, [simplify(e) for e in __allInvariants(sys)])
+    for name, a in flattenActions(sys):
+        own = { Ident.intern(name, 'allowed'), Ident.intern(name, 'required') }
+        _, (allowed, allowed_names), (required, required_names) = compiled[id(a)]
+        __compiled_actions[id(a)] = \
+            (a, env,
+             (allowed, __coneOfInfluence(own | allowed_names, links)[0]),
+             (required, __coneOfInfluence(own | required_names, links)[0]))
     return yices_ctx, env, fintype_els
 
-# If this ends up being used a lot we can pre-build a dictionary
-# (mapping identifiers to actions) to make it more efficient.
+# Compiled 'allowed' and 'required' constraints of actions, keyed by
+# the ids of the actions and tagged with the environment they were
+# compiled against (each entry keeps its action alive). Filled in when
+# a context is set up, so the scenario generators don't have to walk
+# the constraints again. Each constraint is paired with its free
+# variables.
+__compiled_actions: Dict[int, Tuple[Action, Mapping[Ident, Term],
+                                    Tuple[Term, Set[Ident]],
+                                    Tuple[Term, Set[Ident]]]] = {}
+
+# Simplify and compile a list of constraints with the given combinator
+# (compileConj or compileDisj), paired with their free variables.
+def __compileConstraints(env: Mapping[Ident, Term],
+                         es: Sequence[Expr],
+                         combine: Callable[[Mapping[Ident, Term], List[Expr], Optional[TermCache]], Term],
+                         cache: Optional[TermCache] = None) -> Tuple[Term, Set[Ident]]:
+    simplified = [simplify(e) for e in es]
+    names: Set[Ident] = set()
+    for e in simplified:
+        fvsInto(e, names)
+    return combine(env, simplified, cache), names
+
+# The compiled 'allowed' and 'required' constraints of an action,
+# reusing the ones compiled at setup if they're for the same
+# environment (whose variable sets are closed over the invariants; the
+# ones compiled here for another environment are just the free
+# variables of the constraints).
+def __actionConstraints(env: Mapping[Ident, Term],
+                        action: Action) -> Tuple[Tuple[Term, Set[Ident]],
+                                                 Tuple[Term, Set[Ident]]]:
+    entry = __compiled_actions.get(id(action))
+    if entry is not None and entry[1] is env:
+        return entry[2], entry[3]
+    cache = __envTermCache(env)
+    return (__compileConstraints(env, action.allowed, compileConj, cache),
+            __compileConstraints(env, action.required, compileDisj, cache))
+
+# Look up an action by its fully qualified name.
 def getActionByName(sys: System, name: Ident) -> Action:
-    def go(s: System, names: List[str]) -> Action:
-        if len(names) > 1:
-            if names[0] != s.name:
-                raise SolverError("getActionByName: expected system '%s', found '%s'" %
-                                  (names[0], s.name))
-            if len(names) == 2:
-                # Search in current system.
-                for a in s.actions:
-                    if a.name == names[1]:
-                        return a
-                raise SolverError("getActionByName: system '%s' has no action named '%s'" %
-                                  (s.name, names[1]))
-            else:
-                # Recursively search subsystems.
-                for c in s.components:
-                    if c.name == names[1]:
-                        return go(c, names[1:])
-                raise SolverError("getActionByName: system '%s' no component named '%s'" %
-                                  (s.name, names[1]))
-        else:
-            raise SolverError("getActionByName: impossible. name: '%s'" % name)
-    return go(sys, name.toList())
+    a = actionIndex(sys).get(name)
+    if a is None:
+        raise SolverError("getActionByName: system '%s' has no action named '%s'" %
+                          (sys.name, name))
+    return a
 
 # Assert conjunction of all invariants:
 # conj_inv(sys) ≜ ⋀sys.invariants ∧ ⋀{conj_inv(c) | c ∈ sys.components}.
 def assertInvariants(yices_ctx: Context,
                      env: Dict[Ident, Term],
-                     sys: System) -> None:
-    yices_ctx.assert_formulas([compileExpr(env, e) for e in sys.invariants])
+                     sys: System,
+                     cache: Optional[TermCache] = None) -> None:
+    if cache is None:
+        cache = {} # Shared by all subsystems.
+    yices_ctx.assert_formulas([compileExpr(env, simplify(e), cache) for e in sys.invariants])
     if yices_ctx.check_context() == Status.UNSAT:
         raise SolverError("System '%s' invariants are unsatisfiable." % sys.name)
     for c in sys.components:
-        assertInvariants(yices_ctx, env, c)
+        assertInvariants(yices_ctx, env, c, cache)
+
+# Invariants of a system and all its subsystems.
+def __allInvariants(sys: System) -> List[Expr]:
+    invariants: List[Expr] = []
+    def go(s: System) -> None:
+        invariants.extend(s.invariants)
+        for c in s.components:
+            go(c)
+    go(sys)
+    return invariants
+
+# Compiled invariants of systems for assertInvariantsFlat, keyed by the
+# ids of the systems and tagged with the environment they were
+# compiled against, the context (if any) they've been checked in, and
+# the error if they were unsatisfiable there (each entry keeps its
+# system alive).
+__compiled_invariants: Dict[int, Tuple[System, Mapping[Ident, Term], List[Term],
+                                       Optional[Context], Optional[str]]] = {}
+
+# Like assertInvariants, but compiles the invariants of the whole
+# system tree and checks them with a single satisfiability check
+# (rather than one per subsystem). They're checked as assumptions
+# before being asserted, so only if they're unsatisfiable are the
+# subsystems checked one by one to find the one to blame (giving the
+# same error as assertInvariants), and the context is left as it was.
+def assertInvariantsFlat(yices_ctx: Context,
+                         env: Dict[Ident, Term],
+                         sys: System) -> None:
+    # Reuse the compiled invariants if they were compiled against
+    # the same environment.
+    entry = __compiled_invariants.get(id(sys))
+    if entry is not None and entry[1] is env:
+        terms = entry[2]
+        # Already checked (and asserted if satisfiable) in this context.
+        if entry[3] is yices_ctx:
+            if entry[4] is not None:
+                raise SolverError(entry[4])
+            return
+    else:
+        cache = __envTermCache(env)
+        terms = [compileExpr(env, simplify(e), cache) for e in __allInvariants(sys)]
+    error: Optional[str] = None
+    if yices_ctx.check_context_with_assumptions(None, terms) == Status.UNSAT:
+        error = __unsatInvariantsError(yices_ctx, env, sys)
+    __compiled_invariants[id(sys)] = (sys, env, terms, yices_ctx, error)
+    if error is not None:
+        raise SolverError(error)
+    yices_ctx.assert_formulas(terms)
+
+# Find the first subsystem (in the order assertInvariants visits them)
+# whose invariants, together with those of the subsystems before it,
+# are unsatisfiable, and describe it. Only called once the invariants
+# of the whole system are known to be unsatisfiable.
+def __unsatInvariantsError(yices_ctx: Context,
+                           env: Dict[Ident, Term],
+                           sys: System) -> str:
+    cache = __envTermCache(env)
+    terms: List[Term] = []
+    stack: List[System] = [sys]
+    while stack:
+        s = stack.pop()
+        terms.extend(compileExpr(env, simplify(e), cache) for e in s.invariants)
+        if yices_ctx.check_context_with_assumptions(None, terms) == Status.UNSAT:
+            return "System '%s' invariants are unsatisfiable." % s.name
+        stack.extend(reversed(s.components))
+    return "System '%s' invariants are unsatisfiable." % sys.name
 
 # A scenario is a mapping from identifiers to values. A value is (for
 # now) either a bool, int, or string denoting a fintype element.
-@dataclass
+@dataclass(slots=True)
 class Scenario:
     dict: Dict[Ident, bool | int | Ident]
     def __getitem__(self, key: Ident) -> bool | int | Ident:
         return self.dict[key]
     def __setitem__(self, key: Ident, value: bool | int | Ident) -> None:
         self.dict[key] = value
+    def __iter__(self) -> Iterator[Ident]:
+        return iter(self.dict)
     def __str__(self) -> str:
         return '{%s}' % ', '.join('%s: %s' % (key, value) for key, value in self.dict.items())
-    def items(self) -> List[Tuple[Ident, bool | int | Ident]]:
-        return list(self.dict.items())
+    # A live view of the underlying dictionary (not a copy).
+    def items(self) -> ItemsView[Ident, bool | int | Ident]:
+        return self.dict.items()
 
 # Convert a yices model to a Scenario.
 # TODO: provide option to print generated variables (e.g., action variables)?
@@ -202,22 +538,73 @@ def scenarioFromModel(yices_ctx: Context,                       # Yices context.
                       ctx: Mapping[Ident, Type],                # Typing context.
                       env: Mapping[Ident, Term],                # Map variables to yices terms.
                       fintype_els: Mapping[Ident, List[Ident]], # Names of FinType elements.
-                      model: Model                              # Model produced by yices.
+                      model: Model,                             # Model produced by yices.
+                      names: Optional[Set[Ident]] = None        # Only include these variables.
                       ) -> Scenario: # Scenario derived from model.
-    defined_terms = model.collect_defined_terms()
-    scenario: Scenario = Scenario({})
-    for name, term in env.items():
-        if name not in fintype_els and term in defined_terms \
-           and ctx[name] != Ident(None, 'action'):
-            ty: Type = ctx[name]
-            match ty:
-                case 'bool':
-                    scenario[name] = model.get_bool_value(term)
-                case 'int':
-                    scenario[name] = model.get_integer_value(term)
-                case Ident():
-                    scenario[name] = fintype_els[ty][model.get_scalar_value(term)]
-    return scenario
+    return __scenarioFromVars(model, __scenarioVars(ctx, env, fintype_els, names))
+
+# Variables that can appear in scenarios, with their terms, the index
+# of the model getter for their type (see __valuesFromVars), and the
+# elements of their FinType (None for bool and int variables). Computed
+# once when converting many models (e.g., when enumerating), so that
+# no types need to be examined per model.
+ScenarioVars = List[Tuple[Ident, Term, int, Optional[List[Ident]]]]
+
+# All the scenario variables of environments (i.e., the bindings other
+# than FinType elements), keyed by the ids of the environments (each
+# entry keeps its environment alive). Classified once per environment,
+# so converting a single model (e.g., a counterexample) doesn't look at
+# any types either.
+__all_scenario_vars: Dict[int, Tuple[Mapping[Ident, Term], ScenarioVars]] = {}
+
+def __scenarioVars(ctx: Mapping[Ident, Type],
+                   env: Mapping[Ident, Term],
+                   fintype_els: Mapping[Ident, List[Ident]],
+                   names: Optional[Set[Ident]] = None) -> ScenarioVars:
+    entry = __all_scenario_vars.get(id(env))
+    if entry is None:
+        vars: ScenarioVars = []
+        elements = { el for els in fintype_els.values() for el in els }
+        for name, term in env.items():
+            if name in elements:
+                continue
+            ty = ctx[name]
+            if ty == 'bool':
+                vars.append((name, term, 0, None))
+            elif ty == 'int':
+                vars.append((name, term, 1, None))
+            elif isinstance(ty, Ident) and ty != Ident.intern(None, 'action'):
+                vars.append((name, term, 2, fintype_els[ty]))
+        entry = __all_scenario_vars[id(env)] = (env, vars)
+    if names is None:
+        return entry[1]
+    return [v for v in entry[1] if v[0] in names]
+
+# Values of scenario variables in a model, in the same order as the
+# variables (None for those the model leaves undefined).
+ScenarioValues = Tuple[Optional[bool | int | Ident], ...]
+
+def __valuesFromVars(model: Model, vars: ScenarioVars) -> ScenarioValues:
+    defined_terms = set(model.collect_defined_terms())
+    # The python bindings only provide getters for single values, so
+    # look the methods up once rather than on every call. Indexed by
+    # the getter indices of ScenarioVars (0: bool, 1: int, 2: FinType).
+    getters: Tuple[Callable[[Term], Any], ...] = \
+        (model.get_bool_value, model.get_integer_value, model.get_scalar_value)
+    values: List[Optional[bool | int | Ident]] = []
+    for _, term, getter, els in vars:
+        if term in defined_terms:
+            value = getters[getter](term)
+            values.append(value if els is None else els[value])
+        else:
+            values.append(None)
+    return tuple(values)
+
+def __scenarioOfValues(vars: ScenarioVars, values: ScenarioValues) -> Scenario:
+    return Scenario({ var[0]: value for var, value in zip(vars, values) if value is not None })
+
+def __scenarioFromVars(model: Model, vars: ScenarioVars) -> Scenario:
+    return __scenarioOfValues(vars, __valuesFromVars(model, vars))
 
 # Verify UCAs against action constraints (check that the UCAs are
 # ruled out by the constraints). For each UCA u and corresponding
@@ -267,94 +654,451 @@ def scenarioFromModel(yices_ctx: Context,                       # Yices context.
 # I.e., there should not exist a system state in which the UCA context
 # is true and the action is not allowed and not required.
 
-def checkConstraints(yices_ctx: Context,                       # Yices context.
-                     ctx: Mapping[Ident, Type],                # Typing context.
-                     env: Mapping[Ident, Term],                # Map variables to yices terms.
-                     fintype_els: Mapping[Ident, List[Ident]], # Names of FinType elements.
-                     sys: System,                              # System to check.
-                     ucas: Sequence[UCA]                       # UCAs to check.
-                     ) -> Optional[Scenario]: # Return counterexample if found.
+# Find the first UCA (if any) that isn't ruled out by the action
+# constraints. No model is extracted from the solver unless the caller
+# passes 'on_counterexample', which is called with the yices context
+# (while it's still in the satisfying state, so it can build a Model)
+# and the violated UCA.
+def findViolatedUCA(yices_ctx: Context,        # Yices context.
+                    env: Mapping[Ident, Term], # Map variables to yices terms.
+                    sys: System,               # System to check.
+                    ucas: Sequence[UCA],       # UCAs to check.
+                    on_counterexample: Optional[Callable[[Context, UCA], None]] = None,
+                    prune_invariants: bool = False,
+                    assumed_invariants: Optional[Sequence[Expr]] = None
+                    ) -> Optional[UCA]: # Return violated UCA if found.
+    cache: TermCache = __envTermCache(env) # Compiled UCA contexts and invariants.
+    actions: Mapping[Ident, Action] = actionIndex(sys)
+
+    # With 'prune_invariants', the caller hasn't asserted the
+    # invariants (but has checked that they're satisfiable), and only
+    # those relevant to each UCA are assumed along with its context.
+
+    # With 'assumed_invariants', the caller hasn't asserted any
+    # invariants either, and the given ones are assumed in place of the
+    # system's (all of them in each query, or just the relevant ones
+    # when pruning). Since nothing is asserted, the same context can be
+    # used to try out different invariants (e.g., "what if" analyses)
+    # without setting it up again -- as long as the system's own
+    # invariants were never asserted into it (by assertInvariantsFlat),
+    # since nothing can be retracted from a context.
+    links: List[Tuple[Set[Ident], Optional[Expr]]] = []
+    invariants: List[Expr] = []
+    if assumed_invariants is not None:
+        entry = __compiled_invariants.get(id(sys))
+        if entry is not None and entry[3] is yices_ctx and entry[4] is None:
+            raise SolverError("System '%s' invariants are already asserted in the context, "
+                              "so other invariants can't be assumed in their place." % sys.name)
+        invariants = [simplify(e) for e in assumed_invariants]
+        if yices_ctx.check_context_with_assumptions(
+                None, [compileExpr(env, e, cache) for e in invariants]) == Status.UNSAT:
+            raise SolverError("Assumed invariants of system '%s' are unsatisfiable." % sys.name)
+    elif prune_invariants:
+        invariants = [simplify(e) for e in __allInvariants(sys)]
+    if prune_invariants:
+        links = __influenceLinks(sys, invariants)
+
+    # The action part of each query (a.allowed ∨ a.required for
+    # 'issued' UCAs, ¬a.allowed ∧ ¬a.required for 'not issued' ones),
+    # built once per action and UCA type.
+    action_terms: Dict[Tuple[Ident, UCAType], Term] = {}
     for u in ucas:
+        if u.action not in actions:
+            raise SolverError("Unknown action '%s' in UCA" % u.action)
+        key = (u.action, u.type)
+        if key not in action_terms:
+            allowed = env[Ident.intern(u.action, 'allowed')]
+            required = env[Ident.intern(u.action, 'required')]
+            if u.type == 'issued':
+                action_terms[key] = Terms.yor([allowed, required])
+            else: # u.type == 'not_issued'
+                action_terms[key] = Terms.yand([Terms.ynot(allowed), Terms.ynot(required)])
+
+    contexts = [simplify(u.context) for u in ucas]
+    core = __coreLiterals(yices_ctx, env, contexts, cache)
+    unfiltered = [(u, context) for u, context in zip(ucas, contexts)
+                  if not __triviallyVerified(context, core)]
+
+    # Over-approximation: UCAs are expected to be ruled out, so first
+    # check all the remaining queries at once as a single disjunction,
+    # which (when unsatisfiable) verifies all of them in one call.
+    if len(unfiltered) > 1:
+        big = Terms.yor([Terms.yand([action_terms[(u.action, u.type)],
+                                     compileExpr(env, context, cache)])
+                         for u, context in unfiltered])
+        if yices_ctx.check_context_with_assumptions(None, [big]) == Status.UNSAT:
+            for u in ucas:
+                print('Checking %s' % u)
+                print('UCA verified!')
+            return None
+
+    # Otherwise each UCA is checked with its context and the action
+    # part of the query as assumptions rather than assertions in a
+    # pushed frame, so the context itself is never modified and
+    # everything the solver learns carries over from one UCA to the
+    # next.
+    for u, context in zip(ucas, contexts):
         print('Checking %s' % u)
-        yices_ctx.push()
-        
-        a = getActionByName(sys, u.action)
-        allowed = Ident(u.action, 'allowed')
-        required = Ident(u.action, 'required')
-
-        # Assert formulas described by above comments.
-        if u.type == 'issued':
-            yices_ctx.assert_formula(compileExpr(env, land(u.context, lor(allowed, required))))
-        else: # u.type == 'not_issued'
-            yices_ctx.assert_formula(compileExpr(env, conj([u.context,
-                                                            neg(allowed), neg(required)])))
-        
-        if yices_ctx.check_context() == Status.SAT:
-            model = Model.from_context(yices_ctx, 1)
-            yices_ctx.pop()
-            return scenarioFromModel(yices_ctx, ctx, env, fintype_els, model)
+        if __triviallyVerified(context, core):
+            print('UCA verified!')
+            continue
+
+        # Assume formulas described by above comments.
+        assumptions = [action_terms[(u.action, u.type)], compileExpr(env, context, cache)]
+        relevant: List[Expr] = []
+        if prune_invariants:
+            names = fvs(context) | { Ident.intern(u.action, 'allowed'),
+                                     Ident.intern(u.action, 'required') }
+            relevant = __coneOfInfluence(names, links)[1]
+            assumptions.extend(compileExpr(env, e, cache) for e in relevant)
+        elif assumed_invariants is not None:
+            assumptions.extend(compileExpr(env, e, cache) for e in invariants)
+
+        if yices_ctx.check_context_with_assumptions(None, assumptions) == Status.SAT:
+            if on_counterexample is not None:
+                if prune_invariants:
+                    # Extend the counterexample to the irrelevant
+                    # invariants so that it's a valid system state.
+                    ids = { id(e) for e in relevant }
+                    assumptions.extend(compileExpr(env, e, cache) for e in invariants
+                                       if id(e) not in ids)
+                    if yices_ctx.check_context_with_assumptions(None, assumptions) != Status.SAT:
+                        raise SolverError("System '%s' invariants are unsatisfiable." % sys.name)
+                on_counterexample(yices_ctx, u)
+            return u
         else:
             print('UCA verified!')
-        
-        yices_ctx.pop()
 
     return None
 
+# The system being worked on by a worker process (of
+# checkConstraintsParallel or genAllScenarios), sent once when the
+# worker starts (see __initWorker) rather than pickled again for every
+# task, so each worker sets up (and caches) a single copy of it.
+__worker_system: Optional[System] = None
+
+def __initWorker(sys: System) -> None:
+    global __worker_system
+    __worker_system = sys
+
+def __workerSystem() -> System:
+    if __worker_system is None:
+        raise SolverError('Worker process used before being initialized')
+    return __worker_system
+
+# Check a list of UCAs from scratch (in a fresh context, or the
+# system's cached one).
+def __checkUCAs(sys: System, ucas: Sequence[UCA]) -> Optional[Scenario]:
+    ctx = ensureTyped(sys)
+    yices_ctx, env, fintype_els = setupYicesContext(ctx, sys)
+    assertInvariantsFlat(yices_ctx, env, sys)
+    return checkConstraints(yices_ctx, ctx, env, fintype_els, sys, ucas)
+
+# Check a batch of UCAs in a worker process. The progress messages are
+# returned along with the result rather than printed, so that the
+# output of different workers doesn't interleave.
+def __checkUCABatch(ucas: Sequence[UCA]) -> Tuple[str, Optional[Scenario]]:
+    out = io.StringIO()
+    with redirect_stdout(out):
+        counterexample = __checkUCAs(__workerSystem(), ucas)
+    return out.getvalue(), counterexample
+
+# Like checkConstraints, but splits the UCAs into consecutive batches
+# that are checked in parallel in worker processes, each with its own
+# yices context. (Separate processes rather than threads since the yices
+# library isn't built to be used from several threads at once.) The
+# results are consumed in order, so the counterexample returned is the
+# same one checkConstraints would find (and the batches' progress
+# messages are printed in order), and batches that haven't started yet
+# are cancelled once it's found.
+def checkConstraintsParallel(sys: System,                      # System to check.
+                             ucas: Sequence[UCA],              # UCAs to check.
+                             max_workers: Optional[int] = None # Number of worker processes.
+                             ) -> Optional[Scenario]: # Return counterexample if found.
+    if not ucas:
+        return None
+    workers = max_workers or os.cpu_count() or 1
+    size = -(-len(ucas) // workers) # Ceiling division.
+    batches = [ucas[i:i+size] for i in range(0, len(ucas), size)]
+    if len(batches) <= 1:
+        return __checkUCAs(sys, ucas)
+    with ProcessPoolExecutor(workers, initializer = __initWorker,
+                             initargs = (sys,)) as executor:
+        for messages, counterexample in executor.map(__checkUCABatch, batches):
+            print(messages, end = '')
+            if counterexample is not None:
+                executor.shutdown(cancel_futures = True)
+                return counterexample
+    return None
+
+# Conjuncts of an expression (the operands of a top-level AND).
+def __conjuncts(e: Expr) -> List[Expr]:
+    if isinstance(e, (BinaryExpr, NAryExpr)) and e.op == 'AND':
+        return __andOrOperands(e)
+    return [e]
+
+# Whether a (simplified) UCA context rules out its UCA without a
+# solver call of its own: it's 'false', or contains a core literal.
+def __triviallyVerified(context: Expr, core: Set[Expr]) -> bool:
+    return context == 'false' or any(c in core for c in __conjuncts(context))
+
+# Core literal filter: conjuncts shared by the contexts of several UCAs
+# that are unsatisfiable in the yices context on their own. A UCA whose
+# context contains one of them is verified without a solver call of its
+# own. Conjuncts appearing in just one context aren't tested since that
+# would cost as much as checking the UCA itself.
+def __coreLiterals(yices_ctx: Context,
+                   env: Mapping[Ident, Term],
+                   contexts: List[Expr],
+                   cache: TermCache) -> Set[Expr]:
+    counts = Counter(c for e in contexts for c in set(__conjuncts(e)))
+    return { c for c, n in counts.items() if n > 1 and
+             yices_ctx.check_context_with_assumptions(None, [compileExpr(env, c, cache)])
+             == Status.UNSAT }
+
+# Links between the variables of a system: the free variables of each
+# (simplified) invariant, paired with the invariant, and of each
+# action's definition (its 'allowed'/'required' variables and
+# constraints, which don't need to be asserted since setupYicesContext
+# already did), paired with None.
+def __influenceLinks(sys: System,
+                     invariants: List[Expr]
+                     ) -> List[Tuple[Set[Ident], Optional[Expr]]]:
+    links: List[Tuple[Set[Ident], Optional[Expr]]] = [(fvs(e), e) for e in invariants]
+    for name, a in flattenActions(sys):
+        vs = { Ident.intern(name, 'allowed'), Ident.intern(name, 'required') }
+        for e in (*a.allowed, *a.required):
+            fvsInto(e, vs)
+        links.append((vs, None))
+    return links
+
+# Cone of influence of a set of variables: the variables and the
+# invariants transitively sharing variables with it through the links.
+# The invariants outside it are irrelevant to a query over the
+# variables: they can't affect satisfiability as long as they are
+# satisfiable on their own, and don't constrain the variables' values.
+def __coneOfInfluence(names: Set[Ident],
+                      links: List[Tuple[Set[Ident], Optional[Expr]]]
+                      ) -> Tuple[Set[Ident], List[Expr]]:
+    names = set(names)
+    relevant: List[Expr] = []
+    changed = True
+    while changed:
+        changed = False
+        rest: List[Tuple[Set[Ident], Optional[Expr]]] = []
+        for vs, e in links:
+            if names.isdisjoint(vs):
+                rest.append((vs, e))
+            else:
+                names |= vs
+                changed = True
+                if e is not None:
+                    relevant.append(e)
+        links = rest
+    return names, relevant
+
+# Like findViolatedUCA, but returns a counterexample scenario for the
+# first violated UCA.
+def checkConstraints(yices_ctx: Context,                       # Yices context.
+                     ctx: Mapping[Ident, Type],                # Typing context.
+                     env: Mapping[Ident, Term],                # Map variables to yices terms.
+                     fintype_els: Mapping[Ident, List[Ident]], # Names of FinType elements.
+                     sys: System,                              # System to check.
+                     ucas: Sequence[UCA],                      # UCAs to check.
+                     prune_invariants: bool = False,           # See findViolatedUCA.
+                     relevant_only: bool = False,              # Only report relevant variables.
+                     assumed_invariants: Optional[Sequence[Expr]] = None # See findViolatedUCA.
+                     ) -> Optional[Scenario]: # Return counterexample if found.
+    counterexamples: List[Scenario] = []
+    def onCounterexample(c: Context, u: UCA) -> None:
+        model = Model.from_context(c, 1)
+        names: Optional[Set[Ident]] = None
+        if relevant_only:
+            # Only read the values of the variables of the UCA context
+            # and the action's constraints (and its own variables).
+            a = actionIndex(sys)[u.action]
+            names = set()
+            for e in (u.context, *a.allowed, *a.required):
+                fvsInto(e, names)
+            names |= { Ident.intern(u.action, 'allowed'), Ident.intern(u.action, 'required') }
+        counterexamples.append(scenarioFromModel(c, ctx, env, fintype_els, model, names))
+    if findViolatedUCA(yices_ctx, env, sys, ucas, onCounterexample,
+                       prune_invariants, assumed_invariants) is None:
+        return None
+    return counterexamples[0]
+
 # TODO: Add a way to filter out action variables. There should
 # probably be a configuration parameter(s) for the caller to choose
 # which kinds of variables are included in the generated scenarios.
 
-# Generate scenarios compatible with action 'allowed'
-# constraints. WARNING: this generator temporarily modifies the yices
-# context. The context is restored to its initial state once the
-# generator is finished. If you want to stop using the generator early
-# (perhaps it never terminates) you can call .pop() on the context to
-# restore it yourself (but you will have to stop using the generator
-# after that point or else it might erroneously pop the context again).
+# Enumerate the scenarios satisfying a formula without accumulating
+# blocking clauses. Each scenario found splits the rest of the current
+# search space (a cube of literals) into disjoint subspaces: for
+# scenario {x1: v1, ..., xn: vn}, the cubes (x1 ≠ v1), (x1 = v1 ∧ x2 ≠
+# v2), ..., (x1 = v1 ∧ ... ∧ xn ≠ vn). The formula and each cube are
+# passed to the solver as assumptions, so the context is never modified
+# (no clauses accumulate and nothing needs to be popped), and no
+# scenario is found twice.
+
+# Scenarios are projected onto the given set of variables (those that
+# the formula depends on, directly or through the invariants), so
+# scenarios that only differ in don't-care variables are reported once.
+def __enumerateScenarios(yices_ctx: Context,                       # Yices context.
+                         ctx: Mapping[Ident, Type],                # Typing context.
+                         env: Mapping[Ident, Term],                # Map variables to yices terms.
+                         fintype_els: Mapping[Ident, List[Ident]], # Names of FinType elements.
+                         formula: Term,                            # Formula to satisfy.
+                         names: Set[Ident]                         # Variables to project onto.
+                         ) -> Iterator[Scenario]:
+    vars = __scenarioVars(ctx, env, fintype_els, names)
+    for values in __enumerateValues(yices_ctx, env, formula, vars):
+        yield __scenarioOfValues(vars, values)
+
+# A function building the literal that fixes a scenario variable (with
+# the given term and getter index, see ScenarioVars) to a value,
+# chosen once per variable. The literals are built straight from the
+# variable's term: a bool variable is its own literal, and a FinType
+# value's term is in the environment.
+def __valueLiteral(env: Mapping[Ident, Term], term: Term, getter: int) -> Callable[[Any], Term]:
+    if getter == 0:
+        return lambda val: term if val else __ynot(term)
+    elif getter == 1:
+        # Not through __intTerm: model values are unbounded, and
+        # caching them would keep every one alive.
+        return lambda val: Terms.eq(term, Terms.integer(val))
+    else:
+        return lambda val: Terms.eq(term, env[val])
+
+# The enumeration itself, producing the values of the given variables
+# in each scenario (see __enumerateScenarios).
+def __enumerateValues(yices_ctx: Context,
+                      env: Mapping[Ident, Term],
+                      formula: Term,
+                      vars: ScenarioVars) -> Iterator[ScenarioValues]:
+    fixers = [__valueLiteral(env, term, getter) for _, term, getter, _ in vars]
+    cubes: List[List[Term]] = [[]] # Unexplored subspaces.
+    while cubes:
+        cube = cubes.pop()
+        if yices_ctx.check_context_with_assumptions(None, [formula, *cube]) != Status.SAT:
+            continue
+        values = __valuesFromVars(Model.from_context(yices_ctx, 1), vars)
+        yield values
+        # Literals fixing the scenario's values.
+        lits = [fix(val) for fix, val in zip(fixers, values) if val is not None]
+        # Pushed in reverse so that subspaces are explored in order.
+        for j in reversed(range(len(lits))):
+            cubes.append(cube + lits[:j] + [Terms.ynot(lits[j])])
+
+# Generate scenarios compatible with action 'allowed' constraints. The
+# generator doesn't modify the yices context, so it's fine to stop
+# using it early (e.g., if it never terminates).
 def genAllowedScenarios(yices_ctx: Context,                       # Yices context.
                         ctx: Mapping[Ident, Type],                # Typing context.
                         env: Mapping[Ident, Term],                # Map variables to yices terms.
                         fintype_els: Mapping[Ident, List[Ident]], # Names of FinType elements.
                         action: Action
                         ) -> Iterator[Scenario]:
-    yices_ctx.push()
-    yices_ctx.assert_formula(compileExpr(env, conj(action.allowed)))
-    while yices_ctx.check_context() == Status.SAT:
-        model = Model.from_context(yices_ctx, 1)
-        scenario = scenarioFromModel(yices_ctx, ctx, env, fintype_els, model)
-        yield scenario
-        es: List[Expr] = []
-        for name, val in scenario.items():
-            if isinstance(val, bool):
-                es.append(eq(name, 'true' if val else 'false'))
-            elif isinstance(val, int):
-                es.append(eq(name, IntLiteral(int(val))))
-            else:
-                es.append(eq(name, val))
-        yices_ctx.assert_formula(compileExpr(env, neg(conj(es))))
-    yices_ctx.pop()
+    formula, names = __actionConstraints(env, action)[0]
+    yield from __enumerateScenarios(yices_ctx, ctx, env, fintype_els, formula, names)
 
-# Generate scenarios compatible with action 'required'
-# constraints. WARNING: see note about yices context on genAllowedScenarios.
+# Generate scenarios compatible with action 'required' constraints.
 def genRequiredScenarios(yices_ctx: Context,                      # Yices context.
                         ctx: Mapping[Ident, Type],                # Typing context.
                         env: Mapping[Ident, Term],                # Map variables to yices terms.
                         fintype_els: Mapping[Ident, List[Ident]], # Names of FinType elements.
                         action: Action
                         ) -> Iterator[Scenario]:
-    yices_ctx.push()
-    yices_ctx.assert_formula(compileExpr(env, disj(action.required)))
-    while yices_ctx.check_context() == Status.SAT:
-        model = Model.from_context(yices_ctx, 1)
-        scenario = scenarioFromModel(yices_ctx, ctx, env, fintype_els, model)
-        yield scenario
-        es: List[Expr] = []
-        for name, val in scenario.items():
-            if isinstance(val, bool):
-                es.append(eq(name, 'true' if val else 'false'))
-            elif isinstance(val, int):
-                es.append(eq(name, IntLiteral(int(val))))
-            else:
-                es.append(eq(name, val))
-        yices_ctx.assert_formula(compileExpr(env, neg(conj(es))))
-    yices_ctx.pop()
+    formula, names = __actionConstraints(env, action)[1]
+    yield from __enumerateScenarios(yices_ctx, ctx, env, fintype_els, formula, names)
+
+# Like genAllowedScenarios and genRequiredScenarios, but for consumers
+# of many scenarios: returns the names of the variables (shared by all
+# the scenarios) and an iterator of tuples of their values in each
+# scenario (None where a variable is unconstrained), rather than
+# building a Scenario dictionary per scenario.
+def genAllowedScenariosBulk(yices_ctx: Context,                       # Yices context.
+                            ctx: Mapping[Ident, Type],                # Typing context.
+                            env: Mapping[Ident, Term],                # Map variables to yices terms.
+                            fintype_els: Mapping[Ident, List[Ident]], # Names of FinType elements.
+                            action: Action
+                            ) -> Tuple[Tuple[Ident, ...], Iterator[ScenarioValues]]:
+    formula, names = __actionConstraints(env, action)[0]
+    return __bulkScenarios(yices_ctx, ctx, env, fintype_els, formula, names)
+
+def genRequiredScenariosBulk(yices_ctx: Context,                       # Yices context.
+                             ctx: Mapping[Ident, Type],                # Typing context.
+                             env: Mapping[Ident, Term],                # Map variables to yices terms.
+                             fintype_els: Mapping[Ident, List[Ident]], # Names of FinType elements.
+                             action: Action
+                             ) -> Tuple[Tuple[Ident, ...], Iterator[ScenarioValues]]:
+    formula, names = __actionConstraints(env, action)[1]
+    return __bulkScenarios(yices_ctx, ctx, env, fintype_els, formula, names)
+
+def __bulkScenarios(yices_ctx: Context,
+                    ctx: Mapping[Ident, Type],
+                    env: Mapping[Ident, Term],
+                    fintype_els: Mapping[Ident, List[Ident]],
+                    formula: Term,
+                    names: Set[Ident]) -> Tuple[Tuple[Ident, ...], Iterator[ScenarioValues]]:
+    vars = __scenarioVars(ctx, env, fintype_els, names)
+    return tuple(var[0] for var in vars), __enumerateValues(yices_ctx, env, formula, vars)
+
+# Scenarios compatible with the 'allowed' and 'required' constraints of
+# the named action (in states satisfying the system invariants),
+# computed from scratch (in a fresh context, or the system's cached
+# one). The invariants are assumed along with each action formula
+# rather than asserted, so the cached context can still be used with
+# findViolatedUCA's 'assumed_invariants' afterward.
+def __actionScenarios(sys: System, name: Ident) -> Tuple[List[Scenario], List[Scenario]]:
+    ctx = ensureTyped(sys)
+    yices_ctx, env, fintype_els = setupYicesContext(ctx, sys)
+    invariants = __invariantTerms(yices_ctx, env, sys)
+    (allowed, allowed_names), (required, required_names) = \
+        __actionConstraints(env, actionIndex(sys)[name])
+    return (list(__enumerateScenarios(yices_ctx, ctx, env, fintype_els,
+                                      __yand([allowed, *invariants]), allowed_names)),
+            list(__enumerateScenarios(yices_ctx, ctx, env, fintype_els,
+                                      __yand([required, *invariants]), required_names)))
+
+# The compiled invariants of a system (reusing those compiled by
+# assertInvariantsFlat for the same environment), checked to be
+# satisfiable in the context without asserting them.
+def __invariantTerms(yices_ctx: Context,
+                     env: Dict[Ident, Term],
+                     sys: System) -> List[Term]:
+    entry = __compiled_invariants.get(id(sys))
+    if entry is not None and entry[1] is env:
+        if entry[3] is yices_ctx and entry[4] is not None:
+            raise SolverError(entry[4])
+        terms = entry[2]
+    else:
+        cache = __envTermCache(env)
+        terms = [compileExpr(env, simplify(e), cache) for e in __allInvariants(sys)]
+    if yices_ctx.check_context_with_assumptions(None, terms) == Status.UNSAT:
+        raise SolverError(__unsatInvariantsError(yices_ctx, env, sys))
+    return terms
+
+# __actionScenarios in a worker process, reclaiming the literals built
+# while enumerating afterward. Only done in workers since collecting
+# garbage invalidates any unnamed terms held outside this module's
+# caches (e.g., by the caller of genAllScenarios).
+def __actionScenariosWorker(name: Ident) -> Tuple[List[Scenario], List[Scenario]]:
+    scenarios = __actionScenarios(__workerSystem(), name)
+    __collectGarbage()
+    return scenarios
+
+# Generate the allowed and required scenarios of every action in the
+# system, keyed by the fully qualified names of the actions. The
+# enumerations for different actions are independent, so they're run in
+# parallel in worker processes (each with its own yices context). Like
+# the generators, this never returns if some action has infinitely many
+# scenarios.
+def genAllScenarios(sys: System,                       # System.
+                    max_workers: Optional[int] = None  # Number of worker processes.
+                    ) -> Dict[Ident, Tuple[List[Scenario], List[Scenario]]]:
+    names = [name for name, _ in flattenActions(sys)]
+    if len(names) <= 1:
+        return { name: __actionScenarios(sys, name) for name in names }
+    with ProcessPoolExecutor(max_workers, initializer = __initWorker,
+                             initargs = (sys,)) as executor:
+        return dict(zip(names, executor.map(__actionScenariosWorker, names)))
@@ -1,14 +1,18 @@
 # Typechecking systems (a well-typed system can be checked by the
 # solver without the solver throwing an error).
 
+from collections import Counter
 from control import Action, BinaryExpr, Expr, FloatLiteral, \
-    Ident, IntLiteral, System, Type, UCA, UnaryExpr
-from dataclasses import dataclass
-from typing import Dict, Generic, List, Mapping, Optional, Set, TypeVar
+    Ident, IntLiteral, NAryExpr, subExprs, System, Type, UCA, UnaryExpr
+from typing import Any, Callable, Dict, Generic, Iterator, List, Mapping, Optional, Set, Tuple, TypeVar
 
-@dataclass(frozen=True)
+# A plain exception class (rather than a frozen dataclass like
+# SolverError) so that this module can be compiled with mypyc, which
+# doesn't support dataclass exceptions.
 class TypeError(Exception):
-    msg: str
+    def __init__(self, msg: str) -> None:
+        super().__init__(msg)
+        self.msg = msg
 
 # QUESTION: Do we want to enforce lexical scoping rules? The current
 # setup (using a flat dictionary) allows expressions to refer to
@@ -22,23 +26,30 @@ class TypeError(Exception):
 
 def buildTypingCtx(sys: System) -> Dict[Ident, Type]:
     ctx: Dict[Ident, Type] = {} # Typing context.
-    types: List[Type] = []      # Declared types.
+    types: Set[Type] = set()    # Declared types.
     
     def go(s: System, parent: Optional[Ident]) -> None:
         # Qualifier for current system.
-        qualifier: Ident = Ident(parent, s.name)
+        qualifier: Ident = Ident.intern(parent, s.name)
     
-        # Type declarations.
-        seen: List[str] = []
+        # Type declarations. The FinType elements are added to the
+        # context in one batch, and only if the batch is smaller than
+        # expected or overlaps the context do we go looking for the
+        # duplicate to report.
+        seen: Set[str] = set()
+        elements: List[Tuple[Ident, Type]] = []
         for tydecl in s.types:
-            types.append(Ident(qualifier, tydecl.name))
-            for el in tydecl.elements:
-                if Ident(qualifier, el) in ctx:
-                    raise TypeError("Duplicate FinType element: '%s'" % el)
-                else:
-                    ctx[Ident(qualifier, el)] = Ident(qualifier, tydecl.name)
-
-        # State variables. Keep using the same 'seen' list to prevent
+            ty_name = Ident.intern(qualifier, tydecl.name)
+            types.add(ty_name)
+            elements.extend((Ident.intern(qualifier, el), ty_name) for el in tydecl.elements)
+        new_ctx = dict(elements)
+        if len(new_ctx) != len(elements) or not new_ctx.keys().isdisjoint(ctx.keys()):
+            counts = Counter(el for el, _ in elements)
+            dup = next(el for el, _ in elements if counts[el] > 1 or el in ctx)
+            raise TypeError("Duplicate FinType element: '%s'" % dup.name)
+        ctx.update(new_ctx)
+
+        # State variables. Keep using the same 'seen' set to prevent
         # reusing fintype element names as variables.
         for vardecl in s.vars:
             if vardecl.name in seen:
@@ -46,8 +57,8 @@ def buildTypingCtx(sys: System) -> Dict[Ident, Type]:
             elif isinstance(vardecl.ty, Ident) and vardecl.ty not in types:
                 raise TypeError("Unknown type: '%s'" % vardecl.ty)
             else:
-                seen.append(vardecl.name)
-            ctx[Ident(qualifier, vardecl.name)] = vardecl.ty
+                seen.add(vardecl.name)
+            ctx[Ident.intern(qualifier, vardecl.name)] = vardecl.ty
 
         # Actions. Disallow the current action from appearing in its
         # own constraints to avoid paradoxical assertions like "an
@@ -59,12 +70,13 @@ def buildTypingCtx(sys: System) -> Dict[Ident, Type]:
         # is required when it's allowed and ..." or "this action is
         # allowed when it's required or ...".
         for a in s.actions:
-            seen.append(a.name)
-            action_name = Ident(qualifier, a.name)
-            allowed_name = Ident(action_name, 'allowed')
-            required_name = Ident(action_name, 'required')
-            vars: Set[Ident] = set().union(*([fvs(e) for e in a.allowed] +
-                                             [fvs(e) for e in a.required]))
+            seen.add(a.name)
+            action_name = Ident.intern(qualifier, a.name)
+            allowed_name = Ident.intern(action_name, 'allowed')
+            required_name = Ident.intern(action_name, 'required')
+            vars: Set[Ident] = set()
+            for e in (*a.allowed, *a.required):
+                fvsInto(e, vars)
             if allowed_name in vars:
                 raise TypeError("'%s' appears in constraint for action '%s'" %
                                 (allowed_name, a.name))
@@ -86,81 +98,198 @@ def buildTypingCtx(sys: System) -> Dict[Ident, Type]:
 # Free variables of an expression (i.e., the set of variables that
 # appear in the expression).
 def fvs(e: Expr) -> Set[Ident]:
-    match e:
-        case Ident():
-            return { e }
-        case IntLiteral() | FloatLiteral() | 'true' | 'false':
-            return set()
-        case UnaryExpr():
-            return fvs(e.e)
-        case BinaryExpr():
-            return fvs(e.e1).union(fvs(e.e2))
+    acc: Set[Ident] = set()
+    fvsInto(e, acc)
+    return acc
+
+# Add the free variables of an expression to 'acc'. Walks the tree with
+# an explicit stack and a single accumulator (rather than recursively
+# building and merging a set per node), so that the free variables of
+# several expressions can be gathered in one set.
+def fvsInto(e: Expr, acc: Set[Ident]) -> None:
+    stack: List[Expr] = [e]
+    while stack:
+        x = stack.pop()
+        if isinstance(x, Ident):
+            acc.add(x)
+        else:
+            stack.extend(subExprs(x))
 
 def printCtx(ctx: Mapping[Ident, Type]) -> None:
     for name, ty in ctx.items():
         print('%s: %s' % (name, ty))
 
-def tycheckExpr(e: Expr, ctx: Mapping[Ident, Type]) -> Type:
-    match e:
-        case IntLiteral():
-            return 'int'
-        case FloatLiteral():
-            return 'real'
-        case 'true' | 'false':
-            return 'bool'
-        case Ident():
-            if e in ctx:
-                return ctx[e]
-            else:
-                raise TypeError("Unknown name '%s'" % e)
-        case UnaryExpr():
-            if e.op == 'NOT':
-                if tycheckExpr(e.e, ctx) == 'bool':
-                    return 'bool'
-                else:
-                    raise TypeError(msg = 'Expected type bool')
-        case BinaryExpr():
-            ty1, ty2 = tycheckExpr(e.e1, ctx), tycheckExpr(e.e2, ctx)
-            if type(ty1) != type(ty2):
-                raise TypeError('Arguments to binary expression should have the same type')
-            if e.op == 'EQ':
-                return 'bool'
-            elif e.op in ['LT', 'LE', 'GT', 'GE']:
-                if ty1 in ['int', 'real']:
-                    return 'bool'
-                else:
-                    raise TypeError('Expected type int')
-            elif e.op in ['PLUS', 'MINUS', 'MULT', 'DIV']:
-                if ty1 in['int', 'real']:
-                    return 'int'
-                else:
-                    raise TypeError('Expected type int')
-            else: # e.op in ['AND', 'OR', 'WHEN']:
-                if ty1 == 'bool':
-                    return 'bool'
-                else:
-                    raise TypeError('Expected type bool')
-
-def tycheckAction(a: Action, ctx: Mapping[Ident, Type]) -> None:
-    for e in a.allowed:
-        if tycheckExpr(e, ctx) != 'bool':
-            raise TypeError('constraint must have type bool')
-    for e in a.required:
-        if tycheckExpr(e, ctx) != 'bool':
+# Memo table for tycheckExpr mapping ids of already-checked
+# expressions to their types, so that subexpressions shared between
+# invariants/constraints are only checked once. Keys are object ids, so
+# a memo table must not outlive the expressions it was filled from
+# (e.g., create one per call to tycheckSystem).
+TyMemo = Dict[int, Type]
+
+# Typecheck an expression. The tree is walked in post-order with an
+# explicit stack (rather than recursively) so that large generated
+# expressions don't hit Python's recursion limit. Each node's type is
+# computed from the already-memoized types of its children.
+def tycheckExpr(e: Expr, ctx: Mapping[Ident, Type], memo: Optional[TyMemo] = None) -> Type:
+    if memo is None:
+        memo = {}
+    # Module-level functions bound to locals for the loop.
+    children_of, check = subExprs, __tycheckNode
+    stack: List[Expr] = [e]
+    while stack:
+        top = stack[-1]
+        if id(top) in memo:
+            stack.pop()
+            continue
+        children = children_of(top)
+        missing = [c for c in children if id(c) not in memo]
+        if missing:
+            # Reversed so that children are checked left to right.
+            stack.extend(reversed(missing))
+        else:
+            stack.pop()
+            memo[id(top)] = check(top, [memo[id(c)] for c in children], ctx)
+    return memo[id(e)]
+
+# Compute the type of a single node given the types of its children,
+# dispatching on the class of the node.
+def __tycheckNode(e: Expr, tys: List[Type], ctx: Mapping[Ident, Type]) -> Type:
+    return __node_checkers[type(e)](e, tys, ctx)
+
+def __tycheckIntLiteral(e: IntLiteral, tys: List[Type], ctx: Mapping[Ident, Type]) -> Type:
+    return 'int'
+
+def __tycheckFloatLiteral(e: FloatLiteral, tys: List[Type], ctx: Mapping[Ident, Type]) -> Type:
+    return 'real'
+
+# 'true' or 'false'.
+def __tycheckBoolLiteral(e: str, tys: List[Type], ctx: Mapping[Ident, Type]) -> Type:
+    return 'bool'
+
+def __tycheckIdent(e: Ident, tys: List[Type], ctx: Mapping[Ident, Type]) -> Type:
+    # Single probe (types are never None).
+    ty = ctx.get(e)
+    if ty is None:
+        raise TypeError("Unknown name '%s'" % e)
+    return ty
+
+def __tycheckUnaryExpr(e: UnaryExpr, tys: List[Type], ctx: Mapping[Ident, Type]) -> Type:
+    # e.op == 'NOT'
+    if tys[0] == 'bool':
+        return 'bool'
+    else:
+        raise TypeError(msg = 'Expected type bool')
+
+def __tycheckBinaryExpr(e: BinaryExpr, tys: List[Type], ctx: Mapping[Ident, Type]) -> Type:
+    ty1, ty2 = tys
+    # Compare the types themselves (usually the same interned string or
+    # Ident, so this is an identity check), allowing int and real to be
+    # mixed since yices handles mixed arithmetic.
+    if ty1 != ty2 and not (ty1 in ['int', 'real'] and ty2 in ['int', 'real']):
+        raise TypeError('Arguments to binary expression should have the same type')
+    return __binop_checkers[e.op](ty1)
+
+def __tycheckNAryExpr(e: NAryExpr, tys: List[Type], ctx: Mapping[Ident, Type]) -> Type:
+    for ty in tys:
+        if ty != 'bool':
+            raise TypeError('Expected type bool')
+    return 'bool'
+
+__node_checkers: Dict[type, Callable[[Any, List[Type], Mapping[Ident, Type]], Type]] = {
+    IntLiteral:   __tycheckIntLiteral,
+    FloatLiteral: __tycheckFloatLiteral,
+    str:          __tycheckBoolLiteral,
+    Ident:        __tycheckIdent,
+    UnaryExpr:    __tycheckUnaryExpr,
+    BinaryExpr:   __tycheckBinaryExpr,
+    NAryExpr:     __tycheckNAryExpr }
+
+# Result types of binary operators given the (common) type of their
+# arguments.
+
+def __tycheckEq(ty: Type) -> Type:
+    return 'bool'
+
+def __tycheckComparison(ty: Type) -> Type:
+    if ty in ['int', 'real']:
+        return 'bool'
+    else:
+        raise TypeError('Expected type int')
+
+def __tycheckArith(ty: Type) -> Type:
+    if ty in ['int', 'real']:
+        return 'int'
+    else:
+        raise TypeError('Expected type int')
+
+def __tycheckLogical(ty: Type) -> Type:
+    if ty == 'bool':
+        return 'bool'
+    else:
+        raise TypeError('Expected type bool')
+
+__binop_checkers: Dict[str, Callable[[Type], Type]] = {
+    'EQ':    __tycheckEq,
+    'LT':    __tycheckComparison,
+    'LE':    __tycheckComparison,
+    'GT':    __tycheckComparison,
+    'GE':    __tycheckComparison,
+    'PLUS':  __tycheckArith,
+    'MINUS': __tycheckArith,
+    'MULT':  __tycheckArith,
+    'DIV':   __tycheckArith,
+    'AND':   __tycheckLogical,
+    'OR':    __tycheckLogical,
+    'WHEN':  __tycheckLogical }
+
+def tycheckAction(a: Action, ctx: Mapping[Ident, Type], memo: Optional[TyMemo] = None) -> None:
+    if memo is None:
+        memo = {}
+    check = tycheckExpr
+    for e in (*a.allowed, *a.required):
+        if check(e, ctx, memo) != 'bool':
             raise TypeError('constraint must have type bool')
 
-def tycheckSystem(s: System, ctx: Mapping[Ident, Type]) -> None:
-    for e in s.invariants:
-        if tycheckExpr(e, ctx) != 'bool':
-            raise TypeError('system invariant must have type bool')
-    for a in s.actions:
-        tycheckAction(a, ctx)
-    for c in s.components:
-        tycheckSystem(c, ctx)
+# Typecheck a system and all its components: every invariant and action
+# constraint in the tree (all of which must be boolean) is checked in a
+# single loop, sharing one memo table.
+def tycheckSystem(s: System, ctx: Mapping[Ident, Type], memo: Optional[TyMemo] = None) -> None:
+    if memo is None:
+        memo = {}
+    check = tycheckExpr
+    for e, msg in __systemExprs(s):
+        if check(e, ctx, memo) != 'bool':
+            raise TypeError(msg)
+
+# The invariants and action constraints of a system and its components,
+# each with the error to report if it isn't boolean. The component tree
+# is walked with an explicit stack, in the same order as a recursive
+# traversal.
+def __systemExprs(s: System) -> Iterator[Tuple[Expr, str]]:
+    stack: List[System] = [s]
+    while stack:
+        cur = stack.pop()
+        for e in cur.invariants:
+            yield e, 'system invariant must have type bool'
+        for a in cur.actions:
+            for e in (*a.allowed, *a.required):
+                yield e, 'constraint must have type bool'
+        stack.extend(reversed(cur.components))
+
+# Build the typing context of a system and typecheck the system,
+# returning the context. The context is cached on the system (which is
+# immutable), so checking the same system again is free.
+def ensureTyped(s: System) -> Mapping[Ident, Type]:
+    ctx = s._typing_ctx
+    if ctx is None:
+        ctx = buildTypingCtx(s)
+        tycheckSystem(s, ctx)
+        object.__setattr__(s, '_typing_ctx', ctx)
+    return ctx
 
-def tycheckUCA(u: UCA, ctx: Mapping[Ident, Type]) -> None:
+def tycheckUCA(u: UCA, ctx: Mapping[Ident, Type], memo: Optional[TyMemo] = None) -> None:
     # Ensuring that the action named in the UCA is a known control
     # action can happen later when doing SMT stuff, but it could be
     # good to check for it here as well.
-    if tycheckExpr(u.context, ctx) != 'bool':
+    if tycheckExpr(u.context, ctx, memo) != 'bool':
         raise TypeError('context expression of UCA must have type bool')
@@ -8,7 +8,8 @@ Term = int
 
 class Type: ...
 
-class Config: ...
+class Config:
+    def set_config(self, name: str, value: str) -> None: ...
 
 class Status(IntEnum):
     IDLE        = 0
@@ -26,6 +27,8 @@ class Context():
     def push(self) -> bool: ...
     def pop(self) -> bool: ...
     def check_context(self, timeout: Optional[float] = None) -> Status: ...
+    def status(self) -> Status: ...
+    def check_context_with_assumptions(self, params: None, assumptions: List[Term]) -> Status: ...
     def dispose(self) -> None: ...
 
 class Model:
@@ -0,0 +1,7 @@
+# Stubs for the parts of the low-level yices API used directly (i.e.,
+# those not wrapped by the yices module).
+
+from typing import Any, Optional
+
+def yices_garbage_collect(t: Optional[Any], nt: int, tau: Optional[Any], ntau: int,
+                          keep_named: int) -> int: ...